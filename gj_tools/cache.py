@@ -0,0 +1,190 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from .git import git_common_dir
+
+
+class Namespace(object):
+    """A group of cache entries computed the same way. Bumping version makes
+    all the old entries unreachable, they are then aged out by pruning.
+
+    The cache is only an optimization, if it cannot be used, eg the database
+    is locked, read only or corrupt, get() misses and put() does nothing.
+    cache is None if it could not be opened at all."""
+
+    def __init__(self, cache, name, version):
+        self.cache = cache
+        self.name = "%s/%u" % (name, version)
+
+    def get(self, key, default=None):
+        if self.cache is None:
+            return default
+        try:
+            return self.cache.get(self.name, key, default)
+        except (sqlite3.Error, pickle.UnpicklingError):
+            return default
+
+    def put(self, key, value):
+        if self.cache is None:
+            return
+        try:
+            self.cache.put(self.name, key, value)
+        except sqlite3.Error:
+            pass
+
+    def memoize(self, key, fn):
+        """Return the cached value for key, or compute it with fn() and store
+        it"""
+        res = self.get(key, self)
+        if res is self:
+            res = fn()
+            self.put(key, res)
+        return res
+
+
+class ObjectCache(object):
+    """A persistent store of things derived from immutable git objects, for
+    instance get_maintainer output for a commit ID. It is a sqlite database in
+    the common git directory so all worktrees sharing the object store share
+    the cache. Keys must capture every input that affects the value."""
+    dirname = "gj-cache"
+
+    def __init__(self, path=None, max_size=None):
+        from . import config
+
+        if path is None:
+            path = os.path.join(git_common_dir(), self.dirname)
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.join(path, "cache.sqlite3")
+        self.max_size = config.cache_max_size if max_size is None else max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path,
+                                  timeout=30,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            ns TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            atime REAL NOT NULL,
+            PRIMARY KEY (ns, key))""")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self.size = None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def namespace(self, name, version):
+        return Namespace(self, name, version)
+
+    def get(self, ns, key, default=None):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM entries WHERE ns = ? AND key = ?",
+                (ns, key)).fetchone()
+            if row is None:
+                return default
+            try:
+                self.db.execute(
+                    "UPDATE entries SET atime = ? WHERE ns = ? AND key = ?",
+                    (time.time(), ns, key))
+            except sqlite3.OperationalError:
+                # A read only cache can still answer
+                pass
+        return pickle.loads(row[0])
+
+    def put(self, ns, key, value):
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        size = len(ns) + len(key) + len(value)
+        with self.lock:
+            old = self.db.execute(
+                "SELECT size FROM entries WHERE ns = ? AND key = ?",
+                (ns, key)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (ns, key, value, size, time.time()))
+            if self.size is None:
+                self.size = self._total_size()
+            else:
+                self.size += size - (old[0] if old is not None else 0)
+            if self.size > self.max_size:
+                self._prune(self.max_size * 3 // 4)
+
+    def _total_size(self):
+        return self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _prune(self, target):
+        """Delete the least recently used entries until the cache is no larger
+        than target bytes"""
+        size = self._total_size()
+        removed = 0
+        if size > target:
+            cutoff = None
+            for atime, esize in self.db.execute(
+                    "SELECT atime, size FROM entries ORDER BY atime"):
+                size -= esize
+                cutoff = atime
+                if size <= target:
+                    break
+            removed = self.db.execute("DELETE FROM entries WHERE atime <= ?",
+                                      (cutoff, )).rowcount
+        self.size = self._total_size()
+        return removed
+
+    def prune(self, target=None):
+        """Trim the cache to target bytes, returns the number of entries
+        removed"""
+        with self.lock:
+            removed = self._prune(self.max_size if target is None else target)
+            self.db.execute("VACUUM")
+        return removed
+
+    def clear(self, ns=None):
+        with self.lock:
+            if ns is None:
+                self.db.execute("DELETE FROM entries")
+            else:
+                self.db.execute("DELETE FROM entries WHERE ns = ?", (ns, ))
+            self.size = None
+            self.db.execute("VACUUM")
+
+    def stats(self):
+        """Return a list of (namespace, entries, bytes, oldest atime)"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT ns, COUNT(*), SUM(size), MIN(atime) FROM entries "
+                "GROUP BY ns ORDER BY ns").fetchall()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def gj_cache():
+    """Return the ObjectCache for the repository we are currently in"""
+    cdir = git_common_dir()
+    with _caches_lock:
+        res = _caches.get(cdir)
+        if res is None:
+            res = _caches[cdir] = ObjectCache(os.path.join(
+                cdir, ObjectCache.dirname))
+        return res
+
+
+def cache_namespace(name, version):
+    """Return the Namespace of gj_cache() to use for name, if the cache
+    cannot be opened its entries are simply never found"""
+    try:
+        cache = gj_cache()
+    except (OSError, sqlite3.Error):
+        cache = None
+    return Namespace(cache, name, version)
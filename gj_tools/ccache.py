@@ -0,0 +1,144 @@
+"""ccache settings and hit rate history for the builds gj runs"""
+import collections
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+
+from .git import traced_output
+
+# Variables passed into the tuxmake containers with 'exec -e NAME'
+ENV_VARS = ("CCACHE_BASEDIR", "CCACHE_NOHASHDIR")
+
+
+def parse_ccache_stats(text):
+    """Parse the output of ccache --print-stats into a dict"""
+    res = {}
+    for ln in text.splitlines():
+        k, _, v = ln.partition("\t")
+        try:
+            res[k] = int(v)
+        except ValueError:
+            pass
+    return res
+
+
+def ccache_hits(stats):
+    """Return (hits, misses) from parse_ccache_stats()"""
+    return (stats.get("direct_cache_hit", 0) +
+            stats.get("preprocessed_cache_hit", 0), stats.get("cache_miss", 0))
+
+
+def format_hit_rate(hits, misses):
+    total = hits + misses
+    if total == 0:
+        return "no cacheable compiles"
+    return "%u hits %u misses (%.0f%%)" % (hits, misses, 100.0 * hits / total)
+
+
+def host_ccache_stats():
+    """Return the parsed statistics of the local ccache, or None"""
+    try:
+        return parse_ccache_stats(
+            traced_output(["ccache", "--print-stats"],
+                          stderr=subprocess.DEVNULL).decode())
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ccache_env_vars(src, build_dir):
+    """The ccache settings for building src into build_dir. With base_dir
+    covering both, ccache hashes the paths relative to the build directory, and
+    without hash_dir the build directory itself is not hashed. Checkouts and
+    worktrees of the same source share the cache as long as each keeps its
+    build directory at the same place relative to the source, eg
+    src/build-x86."""
+    base = os.path.commonpath(
+        [os.path.realpath(src),
+         os.path.realpath(build_dir)])
+    return {"CCACHE_BASEDIR": base, "CCACHE_NOHASHDIR": "1"}
+
+
+def ccache_env(src, build_dir):
+    """Return a copy of the environment with the ccache settings applied"""
+    env = dict(os.environ)
+    env.update(ccache_env_vars(src, build_dir))
+    return env
+
+
+def history_fn():
+    cache_dir = os.environ.get("XDG_CACHE_HOME",
+                               os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "gj", "ccache-history.jsonl")
+
+
+def append_history(entry):
+    fn = history_fn()
+    try:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        # A single short O_APPEND write does not interleave with other gj's
+        with open(fn, "a") as F:
+            F.write(json.dumps(entry) + "\n")
+    except OSError:
+        pass
+
+
+def load_history():
+    res = []
+    try:
+        with open(history_fn()) as F:
+            for ln in F:
+                try:
+                    res.append(json.loads(ln))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return res
+
+
+@contextmanager
+def ccache_recorder(tree, arch, what, stats_fn=host_ccache_stats,
+                    printer=print):
+    """Snapshot the ccache statistics around a build, then print the hits and
+    misses of the build and add them to the history log. stats_fn returns the
+    statistics of the cache the build uses, printer is called with the
+    message."""
+    before = stats_fn()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        after = stats_fn() if before is not None else None
+        if after is not None:
+            hits, misses = ccache_hits(after)
+            old_hits, old_misses = ccache_hits(before)
+            hits -= old_hits
+            misses -= old_misses
+        # Nothing to say if the build did not use ccache
+        if after is not None and hits + misses:
+            printer("ccache %s: %s" % (arch, format_hit_rate(hits, misses)))
+            append_history(
+                dict(date=time.time(),
+                     tree=os.path.realpath(tree),
+                     arch=arch,
+                     what=what,
+                     hits=hits,
+                     misses=misses,
+                     duration=time.monotonic() - start))
+
+
+def summarize_history(entries, recent=5):
+    """Return a dict of (tree, arch) to (builds, hits, misses, recent hits,
+    recent misses), the recent values are from the last recent builds"""
+    groups = collections.defaultdict(list)
+    for I in sorted(entries, key=lambda x: x["date"]):
+        groups[I["tree"], I["arch"]].append(I)
+    res = {}
+    for k, v in groups.items():
+        last = v[-recent:]
+        res[k] = (len(v), sum(I["hits"] for I in v),
+                  sum(I["misses"] for I in v), sum(I["hits"] for I in last),
+                  sum(I["misses"] for I in last))
+    return res
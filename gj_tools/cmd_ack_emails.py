@@ -22,8 +22,6 @@ import subprocess
 import tempfile
 import time
 
-import httplib2
-
 from . import cmd_pw_am_todo, config
 from .git import *
 
@@ -51,6 +49,7 @@ def google_api_get_credentials():
 def google_api_get_gmail():
     """Get a gmail service object"""
     from apiclient import discovery
+    import httplib2
 
     credentials = google_api_get_credentials()
     http = credentials.authorize(httplib2.Http())
@@ -311,20 +310,15 @@ def args_ack_emails(parser):
 
 def get_pw_messages(pw_files, commits):
     msgs = []
-    for I in git_output(["log", "--pretty=format:%H\t%s"] +
-                        commits.rev_range(),
-                        mode="lines"):
-        commit, _, subject = I.partition(b'\t')
-        commit = git_norm_id(commit)
-        trailers = git_trailers(commit)
+    for commit in commits.load_commits():
         msg_id = None
-        for hdr, value in trailers:
+        for hdr, value in commit.trailers:
             if hdr == "Link" and value.startswith(
                     b"https://lore.kernel.org/r/"):
                 msg_id = "<" + value[26:].decode() + ">"
                 break
 
-        msgs.append(Commit(commit, subject, msg_id))
+        msgs.append(Commit(commit.commit_id, commit.subject, msg_id))
     read_mbox_messages(pw_files, msgs)
     return msgs
 
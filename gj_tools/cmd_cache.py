@@ -0,0 +1,34 @@
+import datetime
+
+from .git import *
+from .cache import gj_cache
+
+
+def args_cache(parser):
+    parser.add_argument("action",
+                        choices={"stats", "prune", "clear"},
+                        help="Operation to perform on the cache")
+    parser.add_argument("--size",
+                        type=int,
+                        default=None,
+                        help="For prune, the target size in MiB")
+
+
+def cmd_cache(args):
+    """Show or trim the persistent result cache in the git directory"""
+    cache = gj_cache()
+    if args.action == "prune":
+        target = None if args.size is None else args.size * 1024 * 1024
+        print("Removed %u entries" % (cache.prune(target)))
+    elif args.action == "clear":
+        cache.clear()
+
+    total = 0
+    print("%-30s %8s %10s  %s" % ("namespace", "entries", "KiB", "oldest use"))
+    for ns, count, size, atime in cache.stats():
+        total += size
+        print("%-30s %8u %10u  %s" %
+              (ns, count, size // 1024,
+               datetime.datetime.fromtimestamp(atime).strftime("%Y-%m-%d")))
+    print("Total %u KiB of %u KiB in %s" %
+          (total // 1024, cache.max_size // 1024, cache.path))
@@ -6,13 +6,13 @@ from .git import *
 
 
 class Sent(object):
-    def __init__(self, branch, date, version):
+    def __init__(self, branch, date, version, obj):
         self.branch = branch
         self.date = date
         self.version = version
 
         self.branch_commit = git_ref_id(branch)
-        self.tags = git_read_object("commit", self.branch_commit).desc
+        self.tags = obj.desc
         if b"Record of sent patches:" not in self.tags[0]:
             self.tags = None
             self.branch_commit = None
@@ -29,33 +29,31 @@ class Sent(object):
 
 
 def get_to_list_branches():
-    """Return the name of all remote branches"""
-    branches = git_output(
-        ["branch", "--all", "--list", "--format", '%(refname)'], mode="lines")
+    """Return the Sent records for all the 'gj send' to-list branches"""
+    to_list = []
+    for name, refs in git_ref_snapshot().to_list.items():
+        to_list.extend((name, I) for I in refs)
+
+    def make_sent(item):
+        (name, I), obj = item
+        return name, Sent(I.refname, I.date, I.version, obj)
+
     res = collections.defaultdict(list)
-    for I in branches:
-        g = re.match(br"^refs/heads/to-list/(\d+-\d+-\d+)/([^/]+)/(\d+)$", I)
-        if g is None:
-            continue
-        d = datetime.datetime.strptime(g.group(1).decode(), "%Y-%m-%d")
-        res[g.group(2).decode()].append(Sent(I, d, int(g.group(3))))
+    objs = git_read_objects("commit", [I.refname for _, I in to_list])
+    for name, sent in git_map(make_sent, zip(to_list, objs)):
+        res[name].append(sent)
     return res
 
 
-def search_message_id(args, sent):
-    if not sent.lore_link:
-        return False
+def search_message_id(sent, tip):
+    """Return the commits in tip since the series was sent that mention its
+    message ID"""
     msgid_stem = re.match(r".+://.*?/\d+-(.+?)@.*$", sent.lore_link).group(1)
     pattern = msgid_stem
 
-    for tip in args.tips:
-        r = GitRange(tip, sent.commits.ancestor)
-        commits = git_output(["log", "--grep", pattern] + r.rev_range(),
-                             mode="lines")
-        if commits:
-            sent.upstream_commits = commits
-            return True
-    return False
+    r = GitRange(tip, sent.commits.ancestor)
+    return git_output(["log", "--grep", pattern] + r.rev_range(),
+                      mode="lines")
 
 
 def args_check_send(parser):
@@ -81,8 +79,21 @@ def cmd_check_send(args):
     if args.num:
         sent_list = sent_list[-1 * args.num:]
 
+    # Every (series, tip) pair is one query in a single git_map so the
+    # number of git processes stays bounded by its pool
+    found = set()
+    queries = [(k, tip) for k in sent_list if sent_dict[k][-1].lore_link
+               for tip in args.tips]
+    for (k, tip), commits in zip(
+            queries,
+            git_map(lambda x: search_message_id(sent_dict[x[0]][-1], x[1]),
+                    queries)):
+        if commits and k not in found:
+            sent_dict[k][-1].upstream_commits = commits
+            found.add(k)
+
     for k in sent_list:
         sent = sent_dict[k][-1]
         print(f"{k} v{sent.version}")
-        if not search_message_id(args, sent):
+        if k not in found:
             print(f"   NOT FOUND {sent.lore_link}")
@@ -1,6 +1,16 @@
+import contextlib
 import copy
+import filecmp
 
 from .git import *
+from .ccache import (ccache_env, ccache_env_vars, ccache_hits, ccache_recorder,
+                     format_hit_rate, host_ccache_stats, load_history,
+                     summarize_history)
+from .container import (BuildContainer, container_ccache_stats,
+                        list_build_containers, stop_build_container)
+from .kbuild import (changed_objects, compile_command, load_compile_commands,
+                     scratch_command, update_compile_commands,
+                     write_compile_commands)
 from . import config
 
 # See https://tuxmake.org/architectures/
@@ -53,11 +63,10 @@ def get_linux_compiler(args, build_dir):
     return config.compiler.split()[-1:]
 
 
-def get_j():
-    # sort of fuzzy way to deal with efficiency cores
-    if os.cpu_count() > 16:
-        return "-j14" # 8 way hyperthreaded
-    return "-j8"
+def get_j(jobs=None):
+    if jobs is None:
+        jobs = get_jobs()
+    return f"-j{jobs}"
 
 
 def get_builddir(args):
@@ -66,57 +75,421 @@ def get_builddir(args):
     return f"build-{args.arch}"
 
 
-def do_linux_make(args, cmd, build_dir):
+def do_linux_make(args, cmd, build_dir, targets=None):
     if args.silent:
         cmd.append("-s")
 
-    if args.make_cmd:
+    if targets:
+        cmd.extend(targets)
+    elif args.make_cmd:
         cmd.append(args.make_cmd)
     else:
         compile_cmd_fn = os.path.join(build_dir, "compile_commands.json")
         if not os.path.exists(compile_cmd_fn):
             cmd.append("all")
             cmd.append("compile_commands.json")
-
-    os.execvp(cmd[0], cmd)
+    return cmd
 
 
-def compile_linux_x86(args, **kwargs):
-    tot = os.getcwd()
-    build_dir = get_builddir(args)
+def compile_linux_x86(args,
+                      jobs=None,
+                      src=None,
+                      build_dir=None,
+                      targets=None,
+                      **kwargs):
+    src = src or os.getcwd()
+    build_dir = build_dir or get_builddir(args)
     cc = " ".join(get_linux_compiler(args, build_dir))
-    cmd = ["make", "-C", os.getcwd(), f"O={build_dir}", f"CC={cc}", get_j()]
-    do_linux_make(args, cmd, build_dir)
-
-
-def clang_linux(args, arch, prefix, ld="ld.lld-18", **kwargs):
-    build_dir = get_builddir(args)
+    cmd = ["make", "-C", src, f"O={build_dir}", f"CC={cc}", get_j(jobs)]
+    return do_linux_make(args, cmd, build_dir, targets)
+
+
+def clang_linux(args,
+                arch,
+                prefix,
+                ld="ld.lld-18",
+                jobs=None,
+                src=None,
+                build_dir=None,
+                targets=None,
+                **kwargs):
+    src = src or os.getcwd()
+    build_dir = build_dir or get_builddir(args)
     cmd = [
-        "make", "-C",
-        os.getcwd(), f"O={build_dir}", f"ARCH={arch}", f"LD={ld}",
+        "make", "-C", src, f"O={build_dir}", f"ARCH={arch}", f"LD={ld}",
         f"CC=clang-18 --target={prefix}",
-        get_j()
+        get_j(jobs)
     ]
-    do_linux_make(args, cmd, build_dir)
-
-
-def tuxmake_linux(args, image, arch, prefix, **kwargs):
+    return do_linux_make(args, cmd, build_dir, targets)
+
+
+def tuxmake_linux(args,
+                  image,
+                  arch,
+                  prefix,
+                  jobs=None,
+                  targets=None,
+                  tty=False,
+                  stdin=True,
+                  **kwargs):
     tot = os.getcwd()
     build_dir = os.path.join(tot, get_builddir(args))
+    # The caller starts the container before running the command
+    container = BuildContainer(image, args.arch, tot)
     cmd = [
-        "docker", "run", "-u", f"{os.getuid()}:{os.getgid()}", "-ti", "--rm",
-        "-v", f"{tot}:{tot}", image
-    ]
-    cmd.extend([
         "make", "-C", tot, f"O={os.path.basename(build_dir)}", f"ARCH={arch}",
-        f"CROSS_COMPILE={prefix}-",
-        get_j()
-    ])
+        f"CROSS_COMPILE={prefix}-", f"CC=ccache {prefix}-gcc",
+        "HOSTCC=ccache gcc",
+        get_j(jobs)
+    ]
 
     if args.silent:
         cmd.append("-s")
+    if targets:
+        cmd.extend(targets)
+    return container.exec_cmd(cmd, tty=tty, stdin=stdin)
 
-    os.execvp(cmd[0], cmd)
+
+def tuxmake_container(args):
+    """Return the BuildContainer that args builds in, or None"""
+    image = arches[args.arch].get("image")
+    if not args.tuxmake or image is None:
+        return None
+    return BuildContainer(image, args.arch, os.getcwd())
+
+
+def build_name(args):
+    """arch[:variant] for the ccache history"""
+    if args.variant:
+        return f"{args.arch}:{args.variant}"
+    return args.arch
+
+
+def linux_build_cmd(args, jobs=None, **kwargs):
+    """Return the command to build the kernel for args.arch. targets
+    replaces the default make goals. For container builds tty and stdin say
+    if the command will be run with a terminal and with a useful stdin."""
+    arch = arches[args.arch]
+    if arch.get("image") is None:
+        return compile_linux_x86(args, jobs=jobs, **kwargs)
+    elif args.tuxmake:
+        return tuxmake_linux(args,
+                             jobs=jobs,
+                             targets=kwargs.get("targets"),
+                             tty=kwargs.get("tty", False),
+                             stdin=kwargs.get("stdin", True),
+                             **arch)
+    return clang_linux(args, jobs=jobs, **arch, **kwargs)
+
+
+# -------------------------------------------------------------------------
+
+
+def parse_matrix(args):
+    """Return a list of args, one for each arch[:variant] in args.matrix"""
+    res = []
+    for I in args.matrix.split(","):
+        arch, _, variant = I.strip().partition(":")
+        if arch not in arches:
+            raise ValueError(
+                f"Unknown arch {arch!r}, expected one of {sorted(arches)}")
+        bargs = copy.copy(args)
+        bargs.arch = arch
+        bargs.variant = variant
+        res.append(bargs)
+    return res
+
+
+def run_prefixed(name, cmd, out_lock, env=None):
+    """Run cmd sending each line of its output to stdout prefixed with name.
+    Returns (exit status, seconds)"""
+    start = time.monotonic()
+    with trace_subprocess(cmd) as rec:
+        proc = subprocess.Popen(cmd,
+                                env=env,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        prefix = f"[{name}] ".encode()
+        for ln in proc.stdout:
+            with out_lock:
+                sys.stdout.buffer.write(prefix + ln)
+                sys.stdout.buffer.flush()
+        proc.stdout.close()
+        status = proc.wait()
+        rec.status = status
+    return status, time.monotonic() - start
+
+
+def build_matrix(args):
+    """Build several arch/variant combinations at once and report the results
+    in a table"""
+    if args.make_cmd:
+        raise ValueError("--menuconfig cannot be used with --matrix")
+    builds = parse_matrix(args)
+    jobs = max(1, (args.jobs or get_jobs()) // len(builds))
+    out_lock = threading.Lock()
+
+    def locked_print(msg):
+        with out_lock:
+            print(msg, flush=True)
+
+    def run(bargs):
+        # Each container has its own cache, the host builds share one and are
+        # recorded together below.
+        container = tuxmake_container(bargs)
+        if container is None:
+            recorder = contextlib.nullcontext()
+        else:
+            container.start()
+            recorder = ccache_recorder(".",
+                                       build_name(bargs),
+                                       "b --matrix",
+                                       container.ccache_stats,
+                                       printer=locked_print)
+        with recorder:
+            return run_prefixed(get_builddir(bargs),
+                                linux_build_cmd(bargs, jobs, stdin=False),
+                                out_lock,
+                                ccache_env(".", get_builddir(bargs)))
+
+    host_builds = [
+        build_name(I) for I in builds if tuxmake_container(I) is None
+    ]
+    if host_builds:
+        recorder = ccache_recorder(".", ",".join(host_builds), "b --matrix")
+    else:
+        recorder = contextlib.nullcontext()
+    with recorder:
+        results = list(git_map(run, builds, max_workers=len(builds)))
+    for bargs in builds:
+        update_compile_commands(get_builddir(bargs))
+
+    print()
+    print("%-30s %-10s %8s" % ("build", "result", "time"))
+    failed = 0
+    for bargs, (status, duration) in zip(builds, results):
+        if status:
+            failed += 1
+        print("%-30s %-10s %7.1fs" %
+              (get_builddir(bargs), "FAIL(%d)" % (status) if status else "PASS",
+               duration))
+    if failed:
+        sys.exit(1)
+
+
+def series_changed_files():
+    """The files changed by the commits in the series and by any uncommitted
+    work"""
+    res = set(git_base_fewest_commits(None).get_changed_files())
+    res.update(git_output(["diff", "--name-only", "HEAD"], mode="lines"))
+    return sorted(res)
+
+
+def ledger_build(args):
+    """Build the kernel recording the result in the BuildLedger, a tree that
+    is already known to build is not built again."""
+    build_dir = get_builddir(args)
+    dot_config = os.path.join(build_dir, ".config")
+    ledger = BuildLedger()
+    container = tuxmake_container(args)
+
+    def ledger_key():
+        # Every build-* directory is written to by builds, not source
+        return ledger.key(
+            ".",
+            dot_config,
+            linux_build_cmd(args),
+            container.image_id() if container is not None else None,
+            exclude=["build-*"])
+
+    # key is None if there are uncommitted changes, the result is not recorded
+    key = ledger_key()
+    res = ledger.lookup(key)
+    if res is not None and res["status"] == 0 and not args.force:
+        ledger.report_hit(res)
+        return
+
+    stats_fn = host_ccache_stats
+    if container is not None:
+        container.start()
+        stats_fn = container.ccache_stats
+    env = ccache_env(".", build_dir)
+
+    start = time.monotonic()
+    status = warnings = 0
+    with ccache_recorder(".", build_name(args), "b", stats_fn):
+        if args.changed:
+            objs = changed_objects(build_dir, series_changed_files())
+            if objs:
+                print("Building %u objects affected by the changes" %
+                      (len(objs)))
+                status, warnings = run_build(linux_build_cmd(args,
+                                                             targets=objs),
+                                             env=env)
+        if status == 0:
+            status, count = run_build(linux_build_cmd(args), env=env)
+            warnings += count
+    duration = time.monotonic() - start
+    ledger.record(key, status, warnings, duration)
+    update_compile_commands(build_dir)
+
+    # The build can change the command, eg by creating compile_commands.json,
+    # so the next run sees a different key.
+    post_key = ledger_key()
+    if post_key != key:
+        ledger.record(post_key, status, warnings, duration)
+    if status:
+        sys.exit(status)
+
+
+# -------------------------------------------------------------------------
+
+# The first error reported by the compiler or make, used to name the file that
+# broke a build
+ERROR_RES = [
+    rb"^([^\s:]+):\d+(?::\d+)?: (?:fatal )?error:",
+    rb"^make\[\d+\]: \*\*\* \[\S+: (\S+)\] Error",
+]
+
+
+def failed_file(output):
+    for expr in ERROR_RES:
+        g = re.search(expr, output, re.MULTILINE)
+        if g is not None:
+            return g.group(1).decode()
+    return None
+
+
+SeriesResult = collections.namedtuple("SeriesResult",
+                                      "commit status duration output")
+
+
+def build_series_chunk(args, pool, commits, jobs):
+    """Build each commit in turn in a leased worktree, stopping at the first
+    failure. The build directory is kept in the worktree, where the main
+    checkout has it, so the next run only rebuilds what changed and ccache
+    entries are shared with every other checkout."""
+    with pool.lease() as wt:
+        if wt is None:
+            raise ValueError("No free worktree in %s" % (pool.path))
+        build_dir = os.path.join(wt, get_builddir(args))
+        os.makedirs(build_dir, exist_ok=True)
+        dot_config = os.path.join(build_dir, ".config")
+        if (not os.path.exists(dot_config)
+                or not filecmp.cmp(args.dot_config, dot_config, shallow=False)):
+            shutil.copyfile(args.dot_config, dot_config)
+
+        env = ccache_env(wt, build_dir)
+        res = []
+        for commit in commits:
+            start = time.monotonic()
+            git_call(["-C", wt, "reset", "-q", "--hard", commit])
+            cmd = linux_build_cmd(args,
+                                  jobs=jobs,
+                                  src=wt,
+                                  build_dir=build_dir)
+            with trace_subprocess(cmd) as rec:
+                proc = subprocess.run(cmd,
+                                      env=env,
+                                      stdin=subprocess.DEVNULL,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT)
+                rec.status = proc.returncode
+            res.append(
+                SeriesResult(commit=commit,
+                             status=proc.returncode,
+                             duration=time.monotonic() - start,
+                             output=proc.stdout))
+            print("%s %s %.1fs" %
+                  (commit[:12], "FAIL" if proc.returncode else "ok",
+                   res[-1].duration),
+                  flush=True)
+            if proc.returncode:
+                break
+        return res
+
+
+def args_build_series(parser):
+    parser.add_argument(
+        "--base",
+        action="append",
+        help="Set the 'upstream' point. Automatically all remote branches",
+        default=None)
+    parser.add_argument("--arch",
+                        action="store",
+                        help="Architecture to build for",
+                        choices=set(arches.keys()),
+                        default="x86")
+    parser.add_argument("-v",
+                        dest="variant",
+                        action="store",
+                        help="Build directory suffix to take the .config from",
+                        default="")
+    parser.add_argument("--parallel",
+                        action="store",
+                        type=int,
+                        help="Build this many parts of the series at once",
+                        default=1)
+
+
+def cmd_build_series(args):
+    """Check that every commit in the series builds, oldest first, using
+    incremental builds in pooled worktrees"""
+    with in_directory(git_root()):
+        if not is_linux():
+            raise ValueError("build-series only supports the kernel")
+        args.dot_config = os.path.abspath(
+            os.path.join(get_builddir(args), ".config"))
+        if not os.path.exists(args.dot_config):
+            raise ValueError("No .config in %s" % (get_builddir(args)))
+        args.ccache = args.silent = args.tuxmake = False
+        args.make_cmd = "all"
+
+        commits = git_base_fewest_commits(args.base)
+        commits.sanity_check()
+        commit_list = list(reversed(commits.get_commit_list()))
+        if not commit_list:
+            print("No commits.")
+            return
+        subjects = {
+            I.commit_id: I.subject.decode()
+            for I in commits.load_commits()
+        }
+
+        # Each worktree builds a contiguous run of the series so its builds
+        # stay incremental.
+        parallel = max(1, min(args.parallel, len(commit_list)))
+        pool = WorktreePool(size=max(config.worktree_pool_size, parallel))
+        step = (len(commit_list) + parallel - 1) // parallel
+        chunks = [
+            commit_list[I:I + step] for I in range(0, len(commit_list), step)
+        ]
+        jobs = max(1, get_jobs() // len(chunks))
+        results = []
+        for res in git_map(lambda x: build_series_chunk(args, pool, x, jobs),
+                           chunks,
+                           max_workers=len(chunks)):
+            results.extend(res)
+
+    print()
+    first_bad = None
+    for I in results:
+        if I.status and first_bad is None:
+            first_bad = I
+        print("%s %-6s %7.1fs  %s" %
+              (I.commit[:12], "FAIL" if I.status else "ok", I.duration,
+               subjects[I.commit]))
+    if first_bad is not None:
+        print()
+        print("First failing commit %s (\"%s\")" %
+              (first_bad.commit[:12], subjects[first_bad.commit]))
+        fn = failed_file(first_bad.output)
+        if fn is not None:
+            print("   in %s" % (fn))
+        for ln in first_bad.output.splitlines()[-20:]:
+            print("   " + ln.decode(errors="replace"))
+        sys.exit(1)
 
 
 # -------------------------------------------------------------------------
@@ -127,13 +500,37 @@ def is_rdma_core():
             and os.path.isdir("rdma-ndd"))
 
 
+def ninja_compile_commands(build_dir):
+    """Regenerate compile_commands.json from build.ninja if ninja has
+    reconfigured the build since it was written"""
+    path = os.path.join(build_dir, "compile_commands.json")
+    try:
+        if (os.stat(path).st_mtime_ns >= os.stat(
+                os.path.join(build_dir, "build.ninja")).st_mtime_ns):
+            return
+    except FileNotFoundError:
+        pass
+
+    # compdb includes the link and custom commands, only keep compiles
+    entries = json.loads(
+        traced_output(["ninja", "-C", build_dir, "-t", "compdb"]))
+    write_compile_commands(path, (I for I in entries if os.path.splitext(
+        I["file"])[1] in (".c", ".cc", ".cpp", ".S")))
+
+
 def compile_rdma_core():
+    build_dir = os.path.join(os.getcwd(), "build")
+    env = ccache_env(".", build_dir)
     if not os.path.isdir("build"):
-        env = copy.copy(os.environ)
-        env["EXTRA_CMAKE_FLAGS"] = "-DCMAKE_EXPORT_COMPILE_COMMANDS=true"
-        env["CC"] = config.compiler.split()[-1]
-        subprocess.check_call(["./build.sh"], env=env)
-    os.execvp("ninja", ["ninja", "-C", os.path.join(os.getcwd(), "build")])
+        cmake_env = copy.copy(env)
+        cmake_env["EXTRA_CMAKE_FLAGS"] = "-DCMAKE_EXPORT_COMPILE_COMMANDS=true"
+        cmake_env["CC"] = config.compiler.split()[-1]
+        traced_call(["./build.sh"], env=cmake_env)
+    try:
+        traced_call(["ninja", "-C", build_dir, get_j()], env=env)
+    except subprocess.CalledProcessError as ex:
+        sys.exit(ex.returncode)
+    ninja_compile_commands(build_dir)
 
 
 # -------------------------------------------------------------------------
@@ -169,20 +566,191 @@ def args_b(parser):
                         action="store",
                         help="Suffix to add to the build directory",
                         default="")
+    parser.add_argument(
+        "--matrix",
+        action="store",
+        help="Build a comma separated list of arch[:variant] in parallel",
+        default=None)
+    parser.add_argument("--jobs",
+                        action="store",
+                        type=int,
+                        help="Total jobs to split between --matrix builds",
+                        default=None)
+    parser.add_argument("--force",
+                        action="store_true",
+                        help="Build even if this tree is already known to build",
+                        default=False)
+    parser.add_argument(
+        "--changed",
+        action="store_true",
+        help="First build the objects affected by the changes in the series",
+        default=False)
 
 
 def cmd_b(args):
     """Compile the current source tree properly"""
     with in_directory(git_root()):
         if is_linux():
-            arch = arches[args.arch]
-            if arch.get("image") is None:
-                compile_linux_x86(args)
-            elif args.tuxmake:
-                tuxmake_linux(args, **arch)
+            if args.matrix:
+                build_matrix(args)
+            elif args.make_cmd:
+                container = tuxmake_container(args)
+                if container is not None:
+                    container.start()
+                os.environ.update(
+                    ccache_env_vars(".", get_builddir(args)))
+                traced_exec(
+                    linux_build_cmd(args,
+                                    tty=sys.stdin.isatty()
+                                    and sys.stdout.isatty()))
             else:
-                clang_linux(args, **arch)
+                ledger_build(args)
         elif is_rdma_core():
             compile_rdma_core()
         else:
             raise ValueError("Don't recongize this tree")
+
+
+# -------------------------------------------------------------------------
+
+
+def args_build_containers(parser):
+    parser.add_argument("--stop",
+                        action="store_true",
+                        help="Stop all the build containers",
+                        default=False)
+
+
+def cmd_build_containers(args):
+    """List the long lived tuxmake build containers and their ccache hit
+    rates"""
+    containers = list_build_containers(config.container_runtime)
+    if args.stop:
+        for name, image, status in containers:
+            if status.startswith("Up"):
+                print("Stopping %s" % (name))
+                stop_build_container(config.container_runtime, name)
+        return
+
+    print("%-40s %-40s %-20s %s" % ("name", "image", "status", "ccache"))
+    for name, image, status in containers:
+        ccache = ""
+        if status.startswith("Up"):
+            stats = container_ccache_stats(config.container_runtime, name)
+            if stats is not None:
+                ccache = format_hit_rate(*ccache_hits(stats))
+        print("%-40s %-40s %-20s %s" % (name, image, status, ccache))
+    cache_dir = os.environ.get("XDG_CACHE_HOME",
+                               os.path.expanduser("~/.cache"))
+    print("ccache directories are in %s" % (os.path.join(cache_dir, "gj")))
+
+
+# -------------------------------------------------------------------------
+
+
+def args_cc(parser):
+    parser.add_argument("--arch",
+                        action="store",
+                        help="Architecture of the build directory to use",
+                        choices=set(arches.keys()),
+                        default="x86")
+    parser.add_argument("-v",
+                        dest="variant",
+                        action="store",
+                        help="Suffix of the build directory to use",
+                        default="")
+    parser.add_argument("files", nargs="+", help="Source files to compile")
+
+
+def cmd_cc(args):
+    """Compile single files by directly running the compiler command the last
+    build used for them. The objects are thrown away, this is a fast check for
+    errors and warnings."""
+    files = [os.path.abspath(I) for I in args.files]
+    with in_directory(git_root()):
+        src = os.getcwd()
+        if is_linux():
+            build_dir = os.path.abspath(get_builddir(args))
+        elif is_rdma_core():
+            build_dir = os.path.abspath("build")
+        else:
+            raise ValueError("Don't recongize this tree")
+        compdb = load_compile_commands(build_dir)
+
+        todo = []
+        for fn in files:
+            cmd = compile_command(build_dir, src, fn, compdb)
+            if cmd is None:
+                raise ValueError("No compile command for %s in %s, run gj b" %
+                                 (os.path.relpath(fn, src), build_dir))
+            todo.append((fn, cmd))
+
+        env = ccache_env(src, build_dir)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def run(item):
+                idx, (fn, (directory, argv)) = item
+                argv = scratch_command(argv,
+                                       os.path.join(tmpdir, "%u.o" % (idx)))
+                with trace_subprocess(argv) as rec:
+                    proc = subprocess.run(argv,
+                                          cwd=directory,
+                                          env=env,
+                                          stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT)
+                    rec.status = proc.returncode
+                return proc
+
+            failed = 0
+            for (fn, _), proc in zip(
+                    todo,
+                    git_map(run,
+                            enumerate(todo),
+                            max_workers=min(len(todo), get_jobs()))):
+                print("%s %s" % ("FAIL" if proc.returncode else "  CC",
+                                 os.path.relpath(fn, src)))
+                sys.stdout.buffer.write(proc.stdout)
+                sys.stdout.flush()
+                if proc.returncode:
+                    failed += 1
+    if failed:
+        sys.exit(1)
+
+
+# -------------------------------------------------------------------------
+
+
+def args_ccache_report(parser):
+    parser.add_argument("--days",
+                        action="store",
+                        type=int,
+                        help="Only include builds from the last N days",
+                        default=30)
+    parser.add_argument("--recent",
+                        action="store",
+                        type=int,
+                        help="Number of builds that count as recent",
+                        default=5)
+
+
+def cmd_ccache_report(args):
+    """Show the ccache hit rate of the builds gj ran, per tree and arch"""
+    cutoff = time.time() - args.days * 24 * 60 * 60
+    summary = summarize_history(
+        [I for I in load_history() if I["date"] >= cutoff], args.recent)
+    if not summary:
+        print("No ccache history in the last %u days" % (args.days))
+        return
+
+    def rate(hits, misses):
+        if hits + misses == 0:
+            return "-"
+        return "%.0f%%" % (100.0 * hits / (hits + misses))
+
+    print("%-50s %-16s %7s %10s %10s %8s" %
+          ("tree", "arch", "builds", "hits", "misses", "recent"))
+    for (tree, arch), (builds, hits, misses, rhits,
+                       rmisses) in sorted(summary.items()):
+        print("%-50s %-16s %7u %10u %10u %8s  (%s overall)" %
+              (tree, arch, builds, hits, misses, rate(rhits, rmisses),
+               rate(hits, misses)))
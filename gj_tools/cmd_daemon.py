@@ -0,0 +1,40 @@
+import gj_tools
+from .git import *
+from . import config, daemon
+from .cmdline import find_cmd_modules
+
+
+def args_daemon(parser):
+    parser.add_argument("--foreground",
+                        action="store_true",
+                        default=False,
+                        help="Do not detach from the terminal")
+    parser.add_argument("--idle-timeout",
+                        type=int,
+                        default=config.daemon_idle_timeout,
+                        help="Exit after this many seconds without a request")
+    parser.add_argument("--stop",
+                        action="store_true",
+                        default=False,
+                        help="Stop the daemon running for this repository")
+
+
+def cmd_daemon(args):
+    """Keep a gj process running for this repository that other gj commands
+    are forwarded to, so they start with warm state"""
+    server = daemon.Daemon(find_cmd_modules(gj_tools), gj_tools,
+                           args.idle_timeout)
+    if args.stop:
+        # The daemon exits once its socket is gone
+        if os.path.exists(server.path):
+            os.unlink(server.path)
+        return
+    if server.is_running():
+        print("gj daemon is already running on %s" % (server.path))
+        return
+    if len(server.path) >= 100:
+        raise ValueError("Socket path %r is too long" % (server.path))
+
+    if not args.foreground:
+        daemon.detach()
+    server.serve()
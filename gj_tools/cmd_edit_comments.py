@@ -19,9 +19,8 @@ def get_parents(commit):
     return res
 
 
-def extract_commit(commit_id, dfn, seq):
+def extract_commit(commit_id, obj, dfn, seq):
     """Extract a single commit text to a file containing the commit name"""
-    obj = git_read_object("commit", commit_id)
     keys = obj.raw_keys
     desc = obj.desc
 
@@ -48,10 +47,10 @@ def same_parents(commit, commit_map):
     return True
 
 
-def update_commit(commit, commit_map):
+def update_commit(commit, commit_map, writer):
     """Read the commit description back from the file and re-create the commit
-    object.  Since we create the commit object directly hash-object will
-    return the same value if the object has not changed."""
+    object.  Since we create the commit object directly the object ID will be
+    the same if the object has not changed."""
     with open(commit.fn, "rb") as F:
         new_desc = list(F.readlines())
 
@@ -62,19 +61,14 @@ def update_commit(commit, commit_map):
         commit_map[commit.commit_id] = commit.commit_id
         return
 
-    with tempfile.NamedTemporaryFile() as F:
-        for k, v in commit.keys:
-            if k == b"parent":
-                v = commit_map[v.decode()].encode()
-            F.write(k + b" " + v + b"\n")
-        F.write(b"\n")
-        for I in new_desc:
-            F.write(I)
-        F.flush()
-
-        new_commit = git_output_id(
-            ["hash-object", "-t", "commit", "-w", F.name])
-        commit_map[commit.commit_id] = new_commit
+    data = []
+    for k, v in commit.keys:
+        if k == b"parent":
+            v = commit_map[v.decode()].encode()
+        data.append(k + b" " + v + b"\n")
+    data.append(b"\n")
+    data.extend(new_desc)
+    commit_map[commit.commit_id] = writer.add("commit", b"".join(data))
 
 
 def topo_sort(commits):
@@ -85,34 +79,58 @@ def topo_sort(commits):
     res = []
     parents = set()
 
-    def add_commit(commit_id):
-        commit = idmap.get(commit_id)
-        if commit is None:
-            # Must be a parent commit outside our edit set.
-            done.add(commit_id)
-            parents.add(commit_id)
-            return
-
-        for I in get_parents(commit):
-            if I not in done:
-                add_commit(I)
-        assert commit.commit_id not in done
-        done.add(commit.commit_id)
-        res.append(commit)
-
-    for I in commits:
-        if I.commit_id not in done:
-            add_commit(I.commit_id)
+    # Depth first walk of the parents, kept on an explicit stack since a long
+    # linear history would exceed the recursion limit.
+    for top in commits:
+        if top.commit_id in done:
+            continue
+        stack = [(top, iter(get_parents(top)))]
+        while stack:
+            commit, todo = stack[-1]
+            for I in todo:
+                if I in done:
+                    continue
+                parent = idmap.get(I)
+                if parent is None:
+                    # Must be a parent commit outside our edit set.
+                    done.add(I)
+                    parents.add(I)
+                    continue
+                stack.append((parent, iter(get_parents(parent))))
+                break
+            else:
+                stack.pop()
+                assert commit.commit_id not in done
+                done.add(commit.commit_id)
+                res.append(commit)
 
     assert len(set(I.commit_id for I in res)) == len(commits)
     return res, parents
 
 
+def check_rewrite(todo, commit_map):
+    """Read back every rewritten commit and the commit it replaces from git and
+    check that both have the same tree, only the descriptions are supposed to
+    change. Raises on the first commit, in topological order, that differs."""
+    changed = [I for I in todo if commit_map[I.commit_id] != I.commit_id]
+    old_objs = git_read_objects("commit", [I.commit_id for I in changed])
+    new_objs = git_read_objects("commit",
+                                [commit_map[I.commit_id] for I in changed])
+    for I, old, new in zip(changed, old_objs, new_objs):
+        if old.keys["tree"] != new.keys["tree"]:
+            raise ValueError(
+                "Rewrite of %s (%s) to %s changed the tree from %s to %s" %
+                (I.commit_id, os.path.basename(I.fn), commit_map[I.commit_id],
+                 old.keys["tree"].decode(), new.keys["tree"].decode()))
+
+
 @contextlib.contextmanager
-def commit_editor(commits, ref):
+def commit_editor(commits, ref, large=False):
     """Yield a list of CommitItems, and when the context closes rewrite the
-    commits using the updated CommitItems"""
-    commits.sanity_check()
+    commits using the updated CommitItems. large allows ranges of any size,
+    otherwise an unusually large range is assumed to be a mistake."""
+    if not large:
+        commits.sanity_check()
 
     old_head = git_commit_id(commits.newest)
 
@@ -124,16 +142,20 @@ def commit_editor(commits, ref):
     with tempfile.TemporaryDirectory() as dirname:
         # todo is an array of CommitItems
         todo = []
-        for num, I in enumerate(reversed(commit_ids)):
-            todo.append(extract_commit(I, dirname, num + 1))
+        commit_ids = list(reversed(commit_ids))
+        for num, (I, obj) in enumerate(
+                zip(commit_ids, git_read_objects("commit", commit_ids))):
+            todo.append(extract_commit(I, obj, dirname, num + 1))
 
         yield todo
 
         todo, parents = topo_sort(todo)
         commit_map = {I: I
                       for I in parents}
-        for I in todo:
-            update_commit(I, commit_map)
+        with git_object_writer() as writer:
+            for I in todo:
+                update_commit(I, commit_map, writer)
+        check_rewrite(todo, commit_map)
 
     new_head = commit_map[old_head]
     if old_head == new_head:
@@ -145,17 +167,27 @@ def commit_editor(commits, ref):
             ["update-ref", "-m", "gj edit-comments", ref, new_head, old_head])
 
 
+def args_large(parser):
+    parser.add_argument(
+        "--large",
+        action="store_true",
+        help="Allow editing ranges with an unusually large number of commits",
+        default=False)
+
+
 def args_edit_comments(parser):
     parser.add_argument(
         "--base",
         action="append",
         help="Set the 'upstream' point. Automatically all remote branches",
         default=None)
+    args_large(parser)
 
 
 def cmd_edit_comments(args):
     """Rewrite commit comments quickly. This directly edits the comments and
     reflows the commit IDs around the changes without altering the checked out
     tree. It is very fast."""
-    with commit_editor(git_base_fewest_commits(args.base), "HEAD") as todo:
+    with commit_editor(git_base_fewest_commits(args.base), "HEAD",
+                       args.large) as todo:
         subprocess.check_call(["emacs"] + [I.fn for I in todo])
@@ -20,8 +20,7 @@ def cmd_jenkins_test(args):
         "fetch", "--no-tags", "-f", config.gerrit_linux,
         "rdma-next-mlx:refs/remotes/gerrit/rdma-next-mlx"
     ])
-    base = git_output_id(
-        ["merge-base", args.rev, "refs/remotes/gerrit/rdma-next-mlx"])
+    base = git_merge_base([args.rev, "refs/remotes/gerrit/rdma-next-mlx"])
 
     lst = GitRange(args.rev, base)
 
@@ -58,14 +57,16 @@ def args_gerrit_add_tags(parser):
     parser.add_argument("issue",
                         action="store",
                         help="The gerrit issue to set")
+    cmd_edit_comments.args_large(parser)
 
 
 def cmd_gerrit_add_tags(args):
     """Rewrite the commit history to add gerrit issue and change id tags"""
     with cmd_edit_comments.commit_editor(git_base_fewest_commits(args.base),
-                                         "HEAD") as todo:
+                                         "HEAD", args.large) as todo:
+        all_trailers = git_trailers_map(I.commit_id for I in todo)
         for I in todo:
-            trailers = git_trailers(I.commit_id)
+            trailers = all_trailers[I.commit_id]
             if any(True for I in trailers if I[0].lower() == "change-id"):
                 continue
             for lineno in range(len(I.desc) - 1, 0, -1):
@@ -93,12 +94,13 @@ def args_gerrit_remove_tags(parser):
         action="append",
         help="Set the 'upstream' point. Automatically all remote branches",
         default=None)
+    cmd_edit_comments.args_large(parser)
 
 
 def cmd_gerrit_remove_tags(args):
     """Rewrite the commit history to remove gerrit issue and change id tags"""
     with cmd_edit_comments.commit_editor(git_base_fewest_commits(args.base),
-                                         "HEAD") as todo:
+                                         "HEAD", args.large) as todo:
         for I in todo:
             for lineno in range(len(I.desc) - 1, 0, -1):
                 if not I.desc[lineno].strip():
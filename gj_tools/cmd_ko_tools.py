@@ -3,6 +3,7 @@ from __future__ import print_function
 import subprocess
 import os
 import shutil
+import io
 import itertools
 from .git import *
 from . import config
@@ -35,7 +36,7 @@ def cmd_to_zero_day(args):
         if wip_commit is not None:
             # Check if the current branch is a subset of our current branch if
             # not we need to delete the remote branch..
-            base = git_output_id(["merge-base", wip_commit, commit])
+            base = git_merge_base([wip_commit, commit])
             if base != wip_commit:
                 force_push.append(":" + wip)
         normal_push.append(I + ":" + wip)
@@ -51,7 +52,7 @@ def cmd_to_zero_day(args):
 # -------------------------------------------------------------------------
 
 
-def show_ahead(top, base, summary_only=False):
+def show_ahead(top, base, summary_only=False, F=sys.stdout):
     commits = git_output([
         "log", "--pretty=oneline", top, "^" + base, "^" + config.linus_master
     ],
@@ -59,12 +60,12 @@ def show_ahead(top, base, summary_only=False):
     if len(commits) == 0:
         return False
 
-    print("%s %u ahead of %s" % (top, len(commits), base))
+    print("%s %u ahead of %s" % (top, len(commits), base), file=F)
     if summary_only:
         return True
 
     for I in commits:
-        print("  " + I.decode())
+        print("  " + I.decode(), file=F)
 
     return True
 
@@ -141,12 +142,8 @@ def find_linus_commit(commit, base):
                              datetime.datetime.now(
                                  datetime.timezone(
                                      datetime.timedelta(minutes=0))))
-    for I in commits:
-        if not I.startswith(b"-"):
-            continue
-
-        I = git_norm_id(I[1:])
-        obj = git_read_object("commit", I)
+    boundary = [git_norm_id(I[1:]) for I in commits if I.startswith(b"-")]
+    for I, obj in zip(boundary, git_read_objects("commit", boundary)):
         committer = obj.keys["committer"]
         date = extract_date(obj.keys["committer"])
         if is_linus_commit(I, obj):
@@ -162,7 +159,7 @@ def find_linus_commit(commit, base):
     return find_linus_merged_commit(oldest[0], base)
 
 
-def show_last_merged(top, base):
+def show_last_merged(top, base, F=sys.stdout):
     commit, obj = find_linus_commit(top, base)
 
     date = extract_date(obj.keys["committer"])
@@ -179,7 +176,18 @@ def show_last_merged(top, base):
     print(" %s merged via %s on %s, %.2f days ago" %
           (obj.keys["committer"].split(b' ')[0].decode(), commit_desc.decode(),
            date.strftime("%B %d, %Y"),
-           (now - date).total_seconds() / (60 * 60 * 24)))
+           (now - date).total_seconds() / (60 * 60 * 24)),
+          file=F)
+
+
+def ko_branch_status(branch, rbranch):
+    """Return the status report text for a single k.o branch"""
+    F = io.StringIO()
+    if not show_ahead(branch, config.linus_master, True, F):
+        print("%s fully merged to %s" % (branch, config.linus_master), file=F)
+    show_ahead(branch, rbranch, F=F)
+    show_last_merged(branch, config.linus_master, F)
+    return F.getvalue()
 
 
 def args_ko_status(parser):
@@ -187,11 +195,12 @@ def args_ko_status(parser):
 
 
 def cmd_ko_status(args):
-    branches = git_output(["branch", "--list", "--format", '%(refname)'],
-                          mode="lines")
-    ko_branches = set(I for I in branches if I.startswith(b"refs/heads/k.o/")
-                      or I.startswith(b"refs/heads/k.o-iommufd/"))
+    refs = git_ref_snapshot()
+    ko_branches = set(
+        refs.with_prefix(b"refs/heads/k.o/") +
+        refs.with_prefix(b"refs/heads/k.o-iommufd/"))
 
+    todo = []
     for I in sorted(ko_branches):
         I = I.decode()
         if "/wip/" in I:
@@ -200,13 +209,13 @@ def cmd_ko_status(args):
                             "refs/remotes/%s/" % (config.remote_name))
         rbranch = rbranch.replace("refs/heads/k.o-iommufd/",
                                   "refs/remotes/%s/" % ("ko-iommufd"))
-        if git_ref_id(rbranch, fail_is_none=True) is None:
+        if rbranch.encode() not in refs.refs:
             continue
         assert rbranch != I
-        if not show_ahead(I, config.linus_master, True):
-            print("%s fully merged to %s" % (I, config.linus_master))
-        show_ahead(I, rbranch)
-        show_last_merged(I, config.linus_master)
+        todo.append((I, rbranch))
+
+    for report in git_map(lambda x: ko_branch_status(*x), todo):
+        sys.stdout.write(report)
 
     show_cycle_progress(config.linus_master)
 
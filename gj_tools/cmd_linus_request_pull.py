@@ -141,7 +141,7 @@ def cmd_linus_pull_request(args):
 
     for I in range(0, 10):
         try:
-            rp = subprocess.check_output(
+            rp = traced_output(
                 ["git", "request-pull", args.linus, ko_repo, tag], env=env)
             break
         except subprocess.CalledProcessError:
@@ -160,8 +160,8 @@ def cmd_linus_pull_request(args):
         assert diffstat_pos != -1
         rp = rp[:diffstat_pos + 2]
         mb = git_base_fewest_commits([args.linus], args.with_merged).ancestor
-        rp = rp + subprocess.check_output(
-            ["git", "diff", "--stat", mb, args.with_merged])
+        rp = rp + git_output(["diff", "--stat", mb, args.with_merged],
+                             mode="raw")
         rp = rp + ("(diffstat from tag %s)\n" % (args.with_merged)).encode()
 
     with tempfile.NamedTemporaryFile(mode="w") as F:
@@ -20,3 +20,49 @@ def cmd_open_conflicts(args):
         ln.partition(b'\t')[-1]
         for ln in git_output(["ls-files", "-u"], mode="lines"))
     os.execvp("emacs", ["emacs"] + sorted(files))
+
+
+def args_internal_startup_bench(parser):
+    parser.add_argument("--runs",
+                        type=int,
+                        default=5,
+                        help="Number of times to start each command")
+    parser.add_argument("--budget",
+                        type=float,
+                        default=250,
+                        help="Fail if any command takes more than this many ms longer than starting python")
+
+
+def cmd_internal_startup_bench(args):
+    """Measure how long each sub command takes to start and parse its arguments"""
+    from .cmdline import Manifest, find_cmd_modules
+    import gj_tools
+    import statistics
+
+    gj = os.path.abspath(sys.argv[0])
+    commands = Manifest(find_cmd_modules(gj_tools), gj_tools).load()
+
+    def median_ms(argv):
+        times = []
+        for I in range(args.runs):
+            start = time.monotonic()
+            subprocess.check_call(argv, stdout=F)
+            times.append((time.monotonic() - start) * 1000)
+        return statistics.median(times)
+
+    over = []
+    with open("/dev/null", "w") as F:
+        # The cost of starting python itself is not ours, only the time on top
+        # of it is compared with the budget.
+        base = median_ms([sys.executable, "-c", "pass"])
+        print("%8.1fms  python startup" % (base))
+        for cmd in commands:
+            ms = median_ms([sys.executable, gj, cmd["name"], "--help"]) - base
+            flag = ""
+            if ms > args.budget:
+                over.append(cmd["name"])
+                flag = " OVER BUDGET"
+            print("%+8.1fms  %s%s" % (ms, cmd["name"], flag))
+    if over:
+        print("%u commands over the %.0fms budget" % (len(over), args.budget))
+        sys.exit(1)
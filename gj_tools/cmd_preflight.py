@@ -14,6 +14,14 @@ def args_linus_check_merge(parser):
     parser.add_argument("--linus",
                         default="remotes/origin/master",
                         help="The branch for Linus's master")
+    parser.add_argument("--fast",
+                        action="store_true",
+                        default=False,
+                        help="Only check for conflicts, do not compile test")
+    parser.add_argument("--force",
+                        action="store_true",
+                        default=False,
+                        help="Compile test even if the merge is known to build")
     parser.add_argument("refs",
                         nargs="+",
                         help="The refs to check mergability for")
@@ -28,25 +36,33 @@ def cmd_linus_check_merge(args):
     if not os.path.exists(dot_config):
         dot_config = os.path.abspath("build-x86/.config")
 
-    # Construct a trial merge between the two trees to evaluate conflicts
-    with git_temp_worktree():
-        git_call(["reset", "--hard", linus])
-
-        linus_ref = git_output(["describe", "--all", linus])
-        for I in to_test:
-            test_ref = git_output(["describe", "--all", I])
-            git_call([
-                "merge", "-m",
-                "automatic merge of %r and %r" % (linus_ref, test_ref),
-                "--no-rerere-autoupdate", "--no-edit", linus, I
-            ])
-
-        merge_commit = git_commit_id("HEAD")
-
-        print("Merge completed, commit is %s" % (merge_commit))
-
+    # Construct a trial merge between the two trees to evaluate conflicts,
+    # this is done in memory and only the final result is checked out.
+    linus_ref = git_output(["describe", "--all", linus])
+    merge_commit = linus
+    for I in to_test:
+        test_ref = git_output(["describe", "--all", I])
+        tree, conflicts = git_merge_tree(merge_commit, I)
+        if conflicts:
+            print("Merge of %s conflicts, tree is %s" %
+                  (test_ref.decode(), tree))
+            for fn in conflicts:
+                print("   %s" % (fn.decode()))
+            sys.exit(1)
+        merge_commit = git_output_id(
+            ["commit-tree", tree, "-p", merge_commit, "-p", I, "-F", "-"],
+            input=("automatic merge of %r and %r" %
+                   (linus_ref, test_ref)).encode())
+
+    print("Merge completed, commit is %s tree is %s" % (merge_commit, tree))
+    if args.fast:
+        return
+
+    with git_temp_worktree(pooled=True):
+        git_call(["reset", "-q", "--hard", merge_commit])
         compile_test(dot_config,
-                     GitRange(merge_commit, linus).get_changed_files())
+                     GitRange(merge_commit, linus).get_changed_files(),
+                     force=args.force)
 
 
 # -------------------------------------------------------------------------
@@ -61,17 +77,18 @@ def get_patch_commit(fn):
 def is_tree_ancestor(commit):
     """True if the commit is an ancestor of something we recognize as part of our
     canonical tree."""
-    for I in [
+    def check(ref):
+        try:
+            return git_is_ancestor(commit, ref)
+        except subprocess.CalledProcessError:
+            return False
+
+    return any(
+        git_map(check, [
             "origin/master", config.linus_master,
             "%s/for-next" % (config.remote_name),
             "%s/for-rc" % (config.remote_name)
-    ]:
-        try:
-            git_call(["merge-base", "--is-ancestor", commit, I])
-            return True
-        except subprocess.CalledProcessError:
-            pass
-    return False
+        ]))
 
 
 def args_internal_check_patch(parser):
@@ -124,11 +141,10 @@ def cmd_internal_check_patch(args):
 
 def format_patches(commits, dfn):
     """Format all the patches and map the commit IDs to the filenames"""
-    commit_ids = commits.get_commit_list()
     res = []
-    for num, I in enumerate(reversed(commit_ids)):
-        obj = git_read_object("commit", I)
-        subject = obj.desc[0].strip().decode()
+    for num, commit in enumerate(reversed(commits.load_commits())):
+        I = commit.commit_id
+        subject = commit.first_line.strip().decode()
         fn = "%04d-%s.patch" % (num + 1, re.sub(r'[^\w]+', '-', subject))
         fn = os.path.join(dfn, fn)
         with open(fn, "wb") as F:
@@ -167,17 +183,15 @@ def cmd_check_patch(args):
         if not os.path.exists(checkpatch[1]):
             nckp = os.path.join(dfn, "checkpatch.pl")
             with open(nckp, "w") as F:
-                subprocess.check_call([
-                    "git", "-C", config.ko_repo, "show",
+                git_output_to_file([
+                    "-C", config.ko_repo, "show",
                     "origin/master:scripts/checkpatch.pl"
-                ],
-                                      stdout=F)
+                ], F)
             with open(os.path.join(dfn, "spelling.txt"), "w") as F:
-                subprocess.check_call([
-                    "git", "-C", config.ko_repo, "show",
+                git_output_to_file([
+                    "-C", config.ko_repo, "show",
                     "origin/master:scripts/spelling.txt"
-                ],
-                                      stdout=F)
+                ], F)
             os.symlink(
                 os.path.join(git_root(), "buildlib/const_structs.checkpatch"),
                 os.path.join(dfn, "const_structs.checkpatch"))
@@ -213,5 +227,9 @@ def cmd_check_patch(args):
                       (checkpatch_stamp, fn, gj_stamp),
                       file=F)
                 print("default %s" % (checkpatch_stamp), file=F)
-        subprocess.check_call(
-            ["ninja", "-k", "%u" % (len(patches) * 2 + 1)], cwd=dfn)
+        traced_call([
+            "ninja", "-k",
+            "%u" % (len(patches) * 2 + 1), "-j",
+            "%u" % (get_jobs())
+        ],
+                    cwd=dfn)
@@ -7,12 +7,6 @@ import time
 from .git import *
 
 
-def get_remote_branches():
-    branches = git_output(
-        ["branch", "--all", "--list", "--format", '%(refname)'], mode="lines")
-    return set(I for I in branches if I.startswith(b"refs/remotes"))
-
-
 def get_merge_base(reference, head="HEAD"):
     """"Return the best ancestor commit for a list of branches."""
     # FIXME: this should iterate and pick the shortest instead
@@ -22,7 +16,7 @@ def get_merge_base(reference, head="HEAD"):
     if isinstance(reference, str):
         reference = [reference]
 
-    return git_output_id(["merge-base", head] + reference)
+    return git_merge_base([head] + list(reference))
 
 
 def is_dirty():
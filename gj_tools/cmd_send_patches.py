@@ -1,6 +1,7 @@
 import contextlib
 import datetime
 import email.utils
+import hashlib
 import itertools
 import mailbox
 import os
@@ -10,6 +11,7 @@ import sys
 import time
 import urllib
 
+from .cache import cache_namespace
 from .cmd_pw_am_todo import form_link_header
 from .git import *
 
@@ -26,18 +28,11 @@ class Series(object):
     cover_commit = None
 
     def _init_versions(self):
-        branches = git_output(
-            ["branch", "--all", "--list", "--format", '%(refname)'],
-            mode="lines")
-
         res = 1
-        for I in branches:
-            g = re.match(f"refs/heads/to-list/[0-9-]+/{self.name}/(\\d+)",
-                         I.decode())
-            if g is not None:
-                ver = int(g.group(1))
-                self.version_branches[ver] = I.decode()[11:]
-                res = max(res, ver + 1)
+        # A version sent more than once is the latest branch for it
+        for I in git_ref_snapshot().to_list.get(self.name, []):
+            self.version_branches[I.version] = I.refname.decode()[11:]
+            res = max(res, I.version + 1)
 
         date = datetime.date.today().isoformat()
         self.version_branches[
@@ -49,10 +44,13 @@ class Series(object):
         self.git_commits = git_commits
         self.name = args.name
         self.prefix = args.prefix
-        self.commits = git_commits.get_commit_list()
-        self.commits.reverse()
-        if git_output(["log", "-1", "--format=%s",
-                       self.commits[-1]]).startswith(b"cover-letter: "):
+        self.commit_info = {
+            I.commit_id: I
+            for I in git_commits.load_commits()
+        }
+        self.commits = list(reversed(self.commit_info.keys()))
+        if self.commit_info[self.commits[-1]].subject.startswith(
+                b"cover-letter: "):
             self.cover_commit = self.commits[-1]
             self.commits.insert(0, self.cover_commit)
             del self.commits[-1]
@@ -82,10 +80,10 @@ class Series(object):
         skip_emails.add("jgg@ziepe.ca")
         newest_commit = 0
         for commit in self.commits:
+            info = self.commit_info[commit]
             newest_commit = max(
-                newest_commit,
-                int(git_output(["log", "-1", "--format=%ct", commit])))
-            for key, val in git_trailers(commit):
+                newest_commit, int(extract_date(info.committer).timestamp()))
+            for key, val in info.trailers:
                 val = val.decode()
                 if '#' in val:
                     val = val.partition('#')[0]
@@ -120,14 +118,29 @@ class Series(object):
         skip_emails.add("stable@vger.kernel.org")
         skip_emails.add("jgg@mellanox.com")
         skip_emails.add("jgg@ziepe.ca")
+        gm_args = ["--no-git", "--no-fixes", "--no-git-fallback", "--no-rolestats", "--multiline"]
+
+        # The output depends on the commit and the MAINTAINERS/script in the
+        # working tree, which are not necessarily committed.
+        h = hashlib.sha1(" ".join(gm_args).encode())
+        for fn in ["MAINTAINERS", "scripts/get_maintainer.pl"]:
+            with open(fn, "rb") as F:
+                h.update(F.read())
+        inputs = h.hexdigest()
+        cache = cache_namespace("get_maintainer", 1)
+
+        def get_maintainer(commit):
+            with tempfile.NamedTemporaryFile() as F:
+                git_output_to_file(["format-patch","--stdout",f"{commit}^!"], F)
+                return traced_output(["scripts/get_maintainer.pl"] + gm_args + [F.name])
+
         for commit in self.commits:
             self.cc_emails[commit].add(("", "patches@lists.linux.dev"))
             if commit is self.cover_commit:
                 continue;
 
-            with tempfile.NamedTemporaryFile() as F:
-                git_output_to_file(["format-patch","--stdout",f"{commit}^!"], F)
-                maints = subprocess.check_output(["scripts/get_maintainer.pl", "--no-git", "--no-fixes", "--no-git-fallback", "--no-rolestats", "--multiline", F.name])
+            maints = cache.memoize(f"{commit} {inputs}",
+                                   lambda: get_maintainer(commit))
             for val in maints.splitlines():
                 addr = email.utils.parseaddr(val.decode())
                 if addr == ('', '') or addr[1] in skip_emails:
@@ -273,17 +286,13 @@ class Series(object):
 
     def make_commit(self, dirname):
         """Record what we created in a git commit"""
-        index_fn = os.path.join(dirname, "git_index")
-        env = {"GIT_INDEX_FILE": index_fn}
-        for fn in self.message_fns.values():
-            blob = git_output_id(["hash-object", "-w", fn], env=env)
-
-            bfn = os.path.basename(fn).decode()
-            git_output(
-                ["update-index", "--add", "--cacheinfo", f"0644,{blob},{bfn}"],
-                env=env)
-        tree = git_output_id(["write-tree"], env=env)
-        os.unlink(index_fn)
+        with git_object_writer() as writer:
+            entries = []
+            for fn in self.message_fns.values():
+                with open(fn, "rb") as F:
+                    blob = writer.add("blob", F.read())
+                entries.append(("100644", os.path.basename(fn), blob))
+            tree = writer.add_tree(entries)
 
         mails_commit = git_output_id(["commit-tree", tree, "-F", "-"],
                                      input="Emails as-sent".encode())
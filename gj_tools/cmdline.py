@@ -1,6 +1,7 @@
 import argparse
 import importlib
 import inspect
+import json
 import os
 import sys
 import gj_tools
@@ -19,23 +20,137 @@ def load_all_commands(name, top_module):
         yield (k, fn, argsfn)
 
 
-def main(cmd_modules, top_module):
+class RecordingParser(object):
+    """Stand in for an argparse parser that records the add_argument() calls
+    made by an args_* function in a form that can be saved as JSON. Things
+    that cannot be saved, like type functions, are dropped, the result is only
+    good enough to build a parser for completion."""
+
+    def __init__(self):
+        self.calls = []
+
+    def add_argument(self, *args, **kwargs):
+        spec = {}
+        for k, v in kwargs.items():
+            if isinstance(v, (set, frozenset)):
+                v = sorted(v)
+            try:
+                json.dumps(v)
+            except TypeError:
+                continue
+            spec[k] = v
+        self.calls.append((list(args), spec))
+
+
+class Manifest(object):
+    """A cached description of every command so the argparse tree can be built
+    without importing the command modules. It is regenerated whenever any of
+    the modules change."""
+    version = 1
+
+    def __init__(self, cmd_modules, top_module):
+        self.cmd_modules = sorted(cmd_modules)
+        self.top_module = top_module
+        self.top_dir = os.path.dirname(top_module.__file__)
+        cache_dir = os.environ.get("XDG_CACHE_HOME",
+                                   os.path.expanduser("~/.cache"))
+        self.path = os.path.join(cache_dir, "gj", "manifest.json")
+
+    def stamp(self):
+        """Identify the exact source files the manifest was made from"""
+        res = [self.version, self.top_dir, sys.version]
+        for I in self.cmd_modules + ["cmdline"]:
+            st = os.stat(os.path.join(self.top_dir, I + ".py"))
+            res.append([I, st.st_mtime_ns, st.st_size])
+        return res
+
+    def generate(self):
+        commands = []
+        for I in self.cmd_modules:
+            for k, fn, argsfn in load_all_commands(I, self.top_module):
+                rec = RecordingParser()
+                try:
+                    argsfn(rec)
+                    calls = rec.calls
+                except Exception:
+                    calls = None
+                commands.append(
+                    dict(name=k[4:].replace('_', '-'),
+                         module=I,
+                         func=k,
+                         help=fn.__doc__,
+                         args=calls))
+        commands.sort(key=lambda x: x["name"])
+        return commands
+
+    def load(self):
+        """Return the list of commands, from the cache if it is valid"""
+        stamp = self.stamp()
+        try:
+            with open(self.path) as F:
+                res = json.load(F)
+            if res["stamp"] == stamp:
+                return res["commands"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        commands = self.generate()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = "%s.%u" % (self.path, os.getpid())
+            with open(tmp, "w") as F:
+                json.dump(dict(stamp=stamp, commands=commands), F)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+        return commands
+
+
+def find_cmd_modules(top_module):
+    """Return the names of all the cmd_* modules in top_module"""
+    return set(
+        I[:-3] for I in os.listdir(os.path.dirname(top_module.__file__))
+        if I.startswith("cmd_") and I.endswith(".py"))
+
+
+def selected_command(argv):
+    """The top level parser only has -h, so the first non-option argument
+    is the sub command"""
+    for I in argv:
+        if not I.startswith("-"):
+            return I
+    return None
+
+
+def main(cmd_modules, top_module, forward=True):
+    completing = "_ARGCOMPLETE" in os.environ
+    selected = None if completing else selected_command(sys.argv[1:])
+
+    # Run the command in the gj daemon if one is running and the command is
+    # safe to run there, this does not return if it does.
+    if forward and selected is not None:
+        from . import daemon
+        daemon.forward(selected, sys.argv[1:])
+
     parser = argparse.ArgumentParser(description='Git helper commands')
     subparsers = parser.add_subparsers(title="Sub Commands", dest="command")
     subparsers.required = True
 
-    commands = []
-    for I in cmd_modules:
-        commands.extend(load_all_commands(I, top_module))
-    commands.sort()
+    commands = Manifest(cmd_modules, top_module).load()
 
-    # build sub parsers for all the loaded commands
-    for k, fn, argsfn in commands:
-        sparser = subparsers.add_parser(k[4:].replace('_', '-'),
-                                        help=fn.__doc__)
+    # build sub parsers for all the commands, only the selected command's
+    # module is imported. Completion uses the recorded arguments instead.
+    for cmd in commands:
+        sparser = subparsers.add_parser(cmd["name"], help=cmd["help"])
         sparser.required = True
-        argsfn(sparser)
-        sparser.set_defaults(func=fn)
+        if cmd["name"] == selected:
+            module = importlib.import_module(top_module.__name__ + "." +
+                                             cmd["module"])
+            getattr(module, "args_" + cmd["func"][4:])(sparser)
+            sparser.set_defaults(func=getattr(module, cmd["func"]))
+        elif completing and cmd["args"] is not None:
+            for args, kwargs in cmd["args"]:
+                sparser.add_argument(*args, **kwargs)
 
     try:
         import argcomplete
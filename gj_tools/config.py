@@ -13,9 +13,39 @@ ko_ssh_server = "git@gitolite.kernel.org"
 # Remote branch that is the master branch from Linus
 linus_master = "remotes/linus/master"
 
+# How to answer read only git queries: "auto" uses pygit2 in-process if it can
+# be imported, "pygit2" requires it and "cli" always runs git. Importing pygit2
+# costs tens of milliseconds so "cli" can be faster for trivial commands.
+git_backend = "auto"
+
+# Upper bound in bytes for the result cache in $GIT_COMMON_DIR/gj-cache, the
+# least recently used entries are dropped once it is exceeded.
+cache_max_size = 256 * 1024 * 1024
+
+# Number of reusable worktrees kept in $GIT_COMMON_DIR/gj-worktrees, and the
+# number of days an unused one is kept before it is removed.
+worktree_pool_size = 2
+worktree_pool_max_age = 14
+
+# Seconds without a request before 'gj daemon' exits
+daemon_idle_timeout = 30 * 60
+
 # Compiler to use for any compile runs
 compiler = "ccache clang-18"
 
+# Number of parallel compile jobs, None picks it from the CPUs, cgroup limits
+# and available memory. build_job_memory_mb is the memory assumed for each job,
+# raise it for LTO or KASAN builds.
+build_jobs = None
+build_job_memory_mb = 768
+
+# Container runtime for the tuxmake cross builds, "docker" or "podman". The
+# build containers mount build_container_mounts, which should cover all the
+# source trees, and exit after build_container_idle_timeout seconds unused.
+container_runtime = "docker"
+build_container_mounts = [os.path.expanduser("~")]
+build_container_idle_timeout = 30 * 60
+
 # Path to the shared clone of kernel.org
 ko_repo = "/home/shared/kernel.org.git"
 
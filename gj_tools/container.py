@@ -0,0 +1,153 @@
+"""Long lived containers for the tuxmake cross compilers"""
+import hashlib
+import os
+import subprocess
+
+from .ccache import ENV_VARS, parse_ccache_stats
+from .git import traced_call, traced_output
+
+# Builds are run under this so the container sees activity for as long as the
+# build runs, even if it is interrupted
+KEEPALIVE = """f=/ccache/.gj-last-use
+(while :; do touch $f; sleep 60; done) & k=$!
+trap 'kill $k 2>/dev/null' EXIT
+trap 'exit 130' INT TERM
+"$@"
+"""
+
+# The main process of the container, it exits once nothing has run in it for
+# the idle timeout and the container is removed.
+IDLE_LOOP = """f=/ccache/.gj-last-use
+touch $f
+trap 'exit 0' TERM
+while sleep 60; do
+    [ $(( $(date +%%s) - $(stat -c %%Y $f) )) -lt %u ] || exit 0
+done
+"""
+
+
+# Containers known to be running by this process
+_started = set()
+
+
+class BuildContainer(object):
+    """A container running one tuxmake image with the source trees and a
+    persistent per-architecture ccache directory mounted. It is started on
+    first use and builds are sent in with exec, avoiding the startup cost of a
+    new container for every build. It stops itself once idle."""
+    label = "gj.build-container"
+
+    def __init__(self, image, arch, src):
+        from . import config
+
+        self.runtime = config.container_runtime
+        self.image = image
+        self.arch = arch
+        self.idle_timeout = config.build_container_idle_timeout
+
+        # The configured mounts normally cover every tree, an unusual tree
+        # gets a container of its own.
+        src = os.path.realpath(src)
+        self.mounts = sorted(
+            set(os.path.realpath(os.path.expanduser(I))
+                for I in config.build_container_mounts))
+        if not any(src == I or src.startswith(I + os.sep)
+                   for I in self.mounts):
+            self.mounts.append(src)
+        h = hashlib.sha1("\0".join([image] + self.mounts).encode())
+        self.name = "gj-build-%s-%s-%s" % (config.user_name, arch,
+                                           h.hexdigest()[:8])
+
+        cache_dir = os.environ.get("XDG_CACHE_HOME",
+                                   os.path.expanduser("~/.cache"))
+        self.ccache_dir = os.path.join(cache_dir, "gj", "ccache-" + arch)
+
+    def is_running(self):
+        try:
+            out = traced_output(
+                [self.runtime, "inspect", "-f", "{{.State.Running}}", self.name],
+                stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return False
+        return out.strip() == b"true"
+
+    def image_id(self):
+        """Return the ID of the local copy of the image, or None if it has not
+        been pulled"""
+        try:
+            out = traced_output(
+                [self.runtime, "image", "inspect", "-f", "{{.Id}}", self.image],
+                stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return None
+        return out.decode().strip()
+
+    def start(self):
+        """Make sure the container is running"""
+        if self.name in _started or self.is_running():
+            _started.add(self.name)
+            return
+        os.makedirs(self.ccache_dir, exist_ok=True)
+        cmd = [
+            self.runtime, "run", "-d", "--rm", "--name", self.name, "--label",
+            self.label, "-u", f"{os.getuid()}:{os.getgid()}", "-v",
+            f"{self.ccache_dir}:/ccache", "-e", "CCACHE_DIR=/ccache"
+        ]
+        if os.path.basename(self.runtime) == "podman":
+            cmd.append("--userns=keep-id")
+        for I in self.mounts:
+            cmd.extend(["-v", f"{I}:{I}"])
+        cmd.extend(
+            [self.image, "sh", "-c", IDLE_LOOP % (self.idle_timeout)])
+        try:
+            traced_output(cmd)
+        except subprocess.CalledProcessError:
+            # Another gj may have started it at the same time
+            if not self.is_running():
+                raise
+        _started.add(self.name)
+
+    def exec_cmd(self, cmd, workdir=None, tty=False, stdin=True):
+        """Return the command to run cmd inside the container. tty must only
+        be set if the command will be run with a terminal as its stdin and
+        stdout, and stdin if its stdin is worth passing in."""
+        res = [self.runtime, "exec"]
+        if tty:
+            res.append("-ti")
+        elif stdin:
+            res.append("-i")
+        if workdir is not None:
+            res.extend(["-w", workdir])
+        # The values come from our environment, see ccache_env()
+        for I in ENV_VARS:
+            res.extend(["-e", I])
+        return res + [self.name, "sh", "-c", KEEPALIVE, "sh"] + cmd
+
+    def ccache_stats(self):
+        return container_ccache_stats(self.runtime, self.name)
+
+
+def container_ccache_stats(runtime, name):
+    """Return the parsed ccache statistics inside a container, or None"""
+    try:
+        return parse_ccache_stats(
+            traced_output([runtime, "exec", name, "ccache", "--print-stats"],
+                          stderr=subprocess.DEVNULL).decode())
+    except subprocess.CalledProcessError:
+        return None
+
+
+def list_build_containers(runtime):
+    """Return a list of (name, image, status) for every build container"""
+    out = traced_output([
+        runtime, "ps", "-a", "--filter", "label=" + BuildContainer.label,
+        "--format", "{{.Names}}\t{{.Image}}\t{{.Status}}"
+    ])
+    return [
+        tuple(I.split("\t", 2)) for I in out.decode().splitlines()
+        if I.count("\t") == 2
+    ]
+
+
+def stop_build_container(runtime, name):
+    traced_call([runtime, "stop", name], stdout=subprocess.DEVNULL)
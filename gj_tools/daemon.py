@@ -0,0 +1,508 @@
+"""A resident gj process for a repository. The daemon keeps the command
+modules imported, the ref snapshot built and a 'git cat-file --batch' running
+for each recently used work tree, and forks a child to run each command a
+client sends it. The client half is used on every gj start so it
+only imports what is needed to talk to the socket, the server half imports
+git lazily."""
+import array
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+SOCKET_NAME = "gj-daemon.sock"
+
+# Commands that are run by the daemon. The forked child has no controlling
+# terminal (or is in a background process group) so only commands that never
+# prompt, start an editor or pager, or rely on job control may be listed.
+FORWARDED_COMMANDS = {
+    "build-containers", "cache", "cc", "ccache-report", "check-patch",
+    "check-send", "internal-applypatch-msg", "internal-check-patch",
+    "ko-status", "root"
+}
+
+
+def find_worktree_top(cdir):
+    """Return the top of the work tree containing cdir, or None"""
+    while not os.path.exists(os.path.join(cdir, ".git")):
+        parent = os.path.dirname(cdir)
+        if parent == cdir:
+            return None
+        cdir = parent
+    return cdir
+
+
+def find_common_dir(cdir):
+    """Return the common git directory for cdir without running git, or None
+    if it cannot be found simply"""
+    cdir = find_worktree_top(cdir)
+    if cdir is None:
+        return None
+    dotgit = os.path.join(cdir, ".git")
+    if os.path.isdir(dotgit):
+        gdir = dotgit
+    else:
+        with open(dotgit) as F:
+            ln = F.readline().strip()
+        if not ln.startswith("gitdir: "):
+            return None
+        gdir = os.path.join(cdir, ln[8:])
+
+    try:
+        with open(os.path.join(gdir, "commondir")) as F:
+            gdir = os.path.join(gdir, F.readline().strip())
+    except FileNotFoundError:
+        pass
+    return os.path.normpath(gdir)
+
+
+def forward(command, argv):
+    """If a daemon is running for this repository and command can run in it
+    then run the command in the daemon and exit with its status. Returns
+    otherwise."""
+    if command not in FORWARDED_COMMANDS:
+        return
+    if os.environ.get("GJ_NO_DAEMON") or os.environ.get("GIT_DIR"):
+        return
+    try:
+        cwd = os.getcwd()
+        common_dir = find_common_dir(cwd)
+    except OSError:
+        return
+    if common_dir is None:
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.join(common_dir, SOCKET_NAME))
+    except OSError:
+        sock.close()
+        return
+
+    umask = os.umask(0o22)
+    os.umask(umask)
+    msg = json.dumps(
+        dict(argv0=os.path.abspath(sys.argv[0]),
+             argv=argv,
+             cwd=cwd,
+             umask=umask,
+             env=dict(os.environ))).encode()
+    sock.sendmsg([msg], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                          array.array("i", [0, 1, 2]))])
+    sock.shutdown(socket.SHUT_WR)
+
+    # The daemon replies with the PID running the command, and later with its
+    # exit status. Signals from the terminal are passed on to the command.
+    F = sock.makefile("rb")
+    ln = F.readline().split()
+    if len(ln) != 2 or ln[0] != b"pid":
+        # The daemon went away before running anything
+        return
+    pid = int(ln[1])
+
+    def pass_signal(signum, frame):
+        try:
+            os.killpg(pid, signum)
+        except OSError:
+            pass
+
+    for I in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT]:
+        signal.signal(I, pass_signal)
+
+    ln = F.readline().split()
+    if len(ln) == 2 and ln[0] == b"exit":
+        os._exit(int(ln[1]))
+    print("gj: lost connection to the gj daemon", file=sys.stderr)
+    os._exit(1)
+
+
+# -------------------------------------------------------------------------
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                 | IN_DELETE)
+
+
+class RepoWatcher(object):
+    """Detect changes to refs, HEAD and the index of a repository. git always
+    updates these by renaming a lock file into place, so watching the
+    directories is enough. inotify is used if possible, otherwise the
+    directory mtimes are polled."""
+
+    def __init__(self, common_dir):
+        self.common_dir = common_dir
+        self.fd = None
+        self.mtimes = None
+        try:
+            import ctypes
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+        except (OSError, AttributeError):
+            pass
+        self.update_watches()
+
+    def dirs(self):
+        res = [self.common_dir]
+        for dpath, dnames, fnames in os.walk(
+                os.path.join(self.common_dir, "refs")):
+            res.append(dpath)
+        wdir = os.path.join(self.common_dir, "worktrees")
+        if os.path.isdir(wdir):
+            res.append(wdir)
+            res.extend(os.path.join(wdir, I) for I in os.listdir(wdir))
+        return res
+
+    def update_watches(self):
+        if self.fd is not None:
+            for I in self.dirs():
+                self.libc.inotify_add_watch(self.fd, os.fsencode(I),
+                                            IN_WATCH_MASK)
+        else:
+            self.mtimes = self.stat_dirs()
+
+    def stat_dirs(self):
+        res = {}
+        for I in self.dirs():
+            try:
+                res[I] = os.stat(I).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return res
+
+    def interesting(self, name):
+        # Our own files and lock files being created do not change anything
+        return not (name.startswith(b"gj-") or name.endswith(b".lock"))
+
+    def changed(self):
+        """Return True if anything changed since the last call"""
+        if self.fd is None:
+            mtimes = self.stat_dirs()
+            res = mtimes != self.mtimes
+            self.mtimes = mtimes
+            return res
+
+        res = False
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            idx = 0
+            while idx < len(buf):
+                wd, mask, cookie, nlen = struct.unpack_from("iIII", buf, idx)
+                name = buf[idx + 16:idx + 16 + nlen].rstrip(b"\0")
+                idx += 16 + nlen
+                if self.interesting(name):
+                    res = True
+        if res:
+            # New ref directories need watches
+            self.update_watches()
+        return res
+
+
+class Daemon(object):
+    # Number of work trees a spare cat-file process is kept ready for
+    max_spares = 8
+
+    def __init__(self, cmd_modules, top_module, idle_timeout):
+        from . import git
+
+        self.git = git
+        self.cmd_modules = cmd_modules
+        self.top_module = top_module
+        self.idle_timeout = idle_timeout
+        self.common_dir = git.git_common_dir()
+        self.path = os.path.join(self.common_dir, SOCKET_NAME)
+        self.children = {}
+        # Work tree top to a started 'git cat-file --batch' that the next
+        # child for that work tree takes over, or None if one should be
+        # started once the repository settles.
+        self.spares = {}
+
+    def is_running(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(16)
+        self.sock_ino = os.stat(self.path).st_ino
+
+    def warm(self):
+        """Load everything a child should inherit"""
+        from .cmdline import Manifest
+        import importlib
+
+        for I in Manifest(self.cmd_modules, self.top_module).load():
+            importlib.import_module(self.top_module.__name__ + "." +
+                                    I["module"])
+        self.git.invalidate_ref_snapshots()
+        self.git.git_ref_snapshot()
+        self.add_spare(find_worktree_top(os.getcwd()))
+
+    def add_spare(self, top):
+        if top is None:
+            return
+        try:
+            spare = self.git.GitCatFile(cwd=top)
+        except OSError:
+            return
+        old = self.spares.pop(top, None)
+        if old is not None:
+            old.close()
+        self.spares[top] = spare
+        while len(self.spares) > self.max_spares:
+            old = self.spares.pop(next(iter(self.spares)))
+            if old is not None:
+                old.close()
+
+    def close_spares(self):
+        """Stop the spares after the repository changed, they are replaced
+        by refill_spares()"""
+        for I in self.spares.values():
+            if I is not None:
+                I.close()
+        self.spares = dict.fromkeys(self.spares)
+
+    def refill_spares(self):
+        for top, spare in list(self.spares.items()):
+            if spare is None:
+                self.add_spare(top)
+
+    def read_request(self, conn):
+        fds = array.array("i")
+        msg, ancdata, flags, addr = conn.recvmsg(
+            65536, socket.CMSG_SPACE(3 * fds.itemsize))
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+        chunks = [msg]
+        while msg:
+            msg = conn.recv(65536)
+            chunks.append(msg)
+        return json.loads(b"".join(chunks)), list(fds)
+
+    def run_child(self, req, fds, cat_files):
+        """In the forked child, become the client's command. cat_files is
+        passed to reset_after_fork()"""
+        from . import cmdline
+        import atexit
+        import traceback
+
+        code = 1
+        try:
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
+            for I in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+                signal.signal(I, signal.default_int_handler
+                              if I == signal.SIGINT else signal.SIG_DFL)
+            for num, fd in enumerate(fds):
+                os.dup2(fd, num)
+                os.close(fd)
+            sys.stdin = open(0, "r", closefd=False)
+            sys.stdout = open(1, "w", closefd=False,
+                              buffering=1 if os.isatty(1) else -1)
+            sys.stderr = open(2, "w", closefd=False, buffering=1)
+
+            os.chdir(req["cwd"])
+            os.umask(req["umask"])
+            os.environ.clear()
+            os.environ.update(req["env"])
+            sys.argv = [req["argv0"]] + req["argv"]
+            self.git.reset_after_fork(cat_files)
+
+            cmdline.main(self.cmd_modules, self.top_module, forward=False)
+            code = 0
+        except KeyboardInterrupt:
+            code = 128 + signal.SIGINT
+        except SystemExit as ex:
+            if ex.code is None:
+                code = 0
+            elif isinstance(ex.code, int):
+                code = ex.code
+            else:
+                print(ex.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+    def accept(self):
+        conn, _ = self.sock.accept()
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize("3i"))
+        if struct.unpack("3i", creds)[1] != os.getuid():
+            conn.close()
+            return
+
+        try:
+            req, fds = self.read_request(conn)
+        except (OSError, ValueError):
+            conn.close()
+            return
+        if len(fds) != 3:
+            conn.close()
+            for I in fds:
+                os.close(I)
+            return
+
+        # The child gets a cat-file that is already running for its work
+        # tree, and the parent starts the next one after replying
+        top = find_worktree_top(req["cwd"])
+        spare = self.spares.pop(top, None)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.sock.close()
+            conn.close()
+            if self.watcher.fd is not None:
+                os.close(self.watcher.fd)
+            for I in self.spares.values():
+                if I is not None:
+                    I.detach()
+            self.run_child(req, fds,
+                           {top: spare} if spare is not None else {})
+        for I in fds:
+            os.close(I)
+        if spare is not None:
+            spare.detach()
+        conn.sendall(b"pid %u\n" % (pid))
+        self.children[pid] = conn
+        self.add_spare(top)
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            conn = self.children.pop(pid, None)
+            if conn is None:
+                continue
+            if os.WIFSIGNALED(status):
+                code = 128 + os.WTERMSIG(status)
+            else:
+                code = os.WEXITSTATUS(status)
+            try:
+                conn.sendall(b"exit %u\n" % (code))
+            except OSError:
+                pass
+            conn.close()
+
+    def socket_replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self.sock_ino
+        except FileNotFoundError:
+            return True
+
+    def serve(self):
+        import select
+        import time
+
+        self.listen()
+        self.watcher = RepoWatcher(self.common_dir)
+        self.warm()
+
+        wakeup_r, wakeup_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        poll = select.poll()
+        poll.register(self.sock, select.POLLIN)
+        poll.register(wakeup_r, select.POLLIN)
+        if self.watcher.fd is not None:
+            poll.register(self.watcher.fd, select.POLLIN)
+
+        last_use = time.monotonic()
+        dirty = False
+        try:
+            while True:
+                # Rebuilding is deferred until things settle so a burst of
+                # ref updates only costs one for-each-ref
+                if dirty:
+                    timeout = 200
+                elif self.watcher.fd is None:
+                    timeout = 1000
+                else:
+                    timeout = 10000
+                events = poll.poll(timeout)
+                if not events and dirty:
+                    self.git.invalidate_ref_snapshots()
+                    self.git.git_ref_snapshot()
+                    self.refill_spares()
+                    dirty = False
+
+                # Repository changes are picked up before any connection
+                # in the same batch is accepted, so the child never
+                # inherits a stale snapshot.
+                if self.watcher.changed():
+                    self.git.invalidate_ref_snapshots()
+                    self.close_spares()
+                    dirty = True
+                for fd, event in events:
+                    if fd == wakeup_r:
+                        os.read(wakeup_r, 4096)
+                    elif fd == self.sock.fileno():
+                        if dirty:
+                            self.git.invalidate_ref_snapshots()
+                            dirty = False
+                        self.accept()
+                        last_use = time.monotonic()
+                self.reap()
+
+                if self.socket_replaced():
+                    break
+                if (not self.children
+                        and time.monotonic() - last_use > self.idle_timeout):
+                    break
+        finally:
+            if not self.socket_replaced():
+                os.unlink(self.path)
+            self.sock.close()
+            self.close_spares()
+
+
+def detach():
+    """Become a background process without a controlling terminal"""
+    if os.fork() != 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    fd = os.open("/dev/null", os.O_RDWR)
+    for I in [0, 1, 2]:
+        os.dup2(fd, I)
+    os.close(fd)
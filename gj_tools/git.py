@@ -1,3 +1,6 @@
+import atexit
+import bisect
+import concurrent.futures
 import os
 import re
 import subprocess
@@ -5,6 +8,13 @@ import tempfile
 import shutil
 import datetime
 import collections
+import fcntl
+import glob
+import hashlib
+import json
+import sys
+import threading
+import time
 from contextlib import contextmanager
 
 # Regex that matches a git object name/SHA1
@@ -34,27 +44,276 @@ def in_directory(dir):
         os.chdir(cdir)
 
 
+class TraceRecord(object):
+    """One subprocess that was run, or for cat "request" one request sent to
+    a long running subprocess"""
+    def __init__(self, argv, cat="subprocess"):
+        self.argv = [I.decode() if isinstance(I, bytes) else str(I)
+                     for I in argv]
+        self.cat = cat
+        self.start = time.monotonic()
+        self.end = self.start
+        self.status = 0
+        self.stdout_bytes = None
+        self.objects = None
+        self.note = None
+        self.tid = threading.get_ident()
+
+    def name(self):
+        """Short name used to group similar commands together, eg 'git log'"""
+        prog = os.path.basename(self.argv[0])
+        args = self.argv[1:]
+        if prog == "git":
+            # Skip over global options like -C dir
+            while args and args[0].startswith("-"):
+                if args[0] in ("-C", "-c") and len(args) > 1:
+                    args = args[1:]
+                args = args[1:]
+            if args:
+                return "git " + args[0]
+        elif prog in ("perl", "python3", "sh") and args:
+            return prog + " " + os.path.basename(args[0])
+        return prog
+
+
+class SubprocessTrace(object):
+    """Record the argv, wall time, exit status and amount of output of every
+    subprocess, and of every request to a long running one such as git
+    cat-file --batch. At exit a summary table is printed to stderr, with the
+    requests counted apart from the subprocesses, and optionally a
+    Chrome trace JSON timeline is written that can be loaded into Perfetto or
+    chrome://tracing."""
+    def __init__(self, spec):
+        self.json_fn = None
+        if spec.endswith(".json"):
+            # %p is replaced with the PID so that gj commands started by other
+            # gj commands do not overwrite each other's trace.
+            self.json_fn = os.path.abspath(spec.replace("%p", str(
+                os.getpid())))
+        self.records = []
+        self.start = time.monotonic()
+        self.reported = False
+        atexit.register(self.report)
+
+    @contextmanager
+    def record(self, argv, cat="subprocess"):
+        rec = TraceRecord(argv, cat)
+        try:
+            yield rec
+        except subprocess.CalledProcessError as ex:
+            rec.status = ex.returncode
+            raise
+        except BaseException:
+            rec.status = None
+            raise
+        finally:
+            rec.end = time.monotonic()
+            self.records.append(rec)
+
+    def write_json(self):
+        events = []
+        for I in self.records:
+            args = {"argv": I.argv, "status": I.status}
+            if I.stdout_bytes is not None:
+                args["stdout_bytes"] = I.stdout_bytes
+            if I.objects is not None:
+                args["objects"] = I.objects
+            if I.note is not None:
+                args["note"] = I.note
+            events.append({
+                "name": I.name(),
+                "cat": I.cat,
+                "ph": "X",
+                "ts": int((I.start - self.start) * 1000000),
+                "dur": int((I.end - I.start) * 1000000),
+                "pid": os.getpid(),
+                "tid": I.tid,
+                "args": args
+            })
+        with open(self.json_fn, "w") as F:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, F)
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+
+        summary = {}
+        procs = [I for I in self.records if I.cat == "subprocess"]
+        requests = [I for I in self.records if I.cat == "request"]
+        for I in self.records:
+            name = I.name()
+            if I.cat != "subprocess":
+                name = "%s (%ss)" % (name, I.cat)
+            total, worst, count, failed, out = summary.get(
+                name, (0, 0, 0, 0, 0))
+            dur = I.end - I.start
+            summary[name] = (total + dur, max(worst, dur), count + 1,
+                             failed + (I.status != 0), out +
+                             (I.stdout_bytes or 0))
+
+        F = sys.stderr
+        print("gj trace: %s: %u subprocesses, %.3fs in subprocesses, %.3fs wall"
+              % (" ".join([os.path.basename(sys.argv[0])] + sys.argv[1:2]),
+                 len(procs),
+                 sum(I.end - I.start for I in procs),
+                 time.monotonic() - self.start),
+              file=F)
+        if requests:
+            print("gj trace: %u requests for %u objects to running "
+                  "subprocesses, %.3fs waiting for them" %
+                  (len(requests), sum(I.objects or 0 for I in requests),
+                   sum(I.end - I.start for I in requests)),
+                  file=F)
+        print("%9s %9s %6s %6s %10s  %s" %
+              ("total", "max", "count", "failed", "stdout", "command"),
+              file=F)
+        for name, v in sorted(summary.items(), key=lambda x: -x[1][0]):
+            print("%8.3fs %8.3fs %6u %6u %10u  %s" % (v + (name, )), file=F)
+
+        if self.json_fn is not None:
+            self.write_json()
+            print("gj trace: wrote %s" % (self.json_fn), file=F)
+
+
+# Set GJ_TRACE=1 to get a summary of every subprocess gj ran when it exits,
+# or GJ_TRACE=file.json to also write a Chrome trace timeline.
+_trace = None
+if os.environ.get("GJ_TRACE"):
+    _trace = SubprocessTrace(os.environ["GJ_TRACE"])
+
+
+# git commands that can change refs, running any of these throws away the
+# RefSnapshots
+_REF_UPDATE_CMDS = {
+    "am", "branch", "checkout", "cherry-pick", "clone", "commit", "fetch",
+    "merge", "notes", "pull", "push", "rebase", "remote", "replace", "reset",
+    "revert", "stash", "switch", "symbolic-ref", "tag", "update-ref",
+    "worktree"
+}
+
+# git commands that never change refs. Anything that is in neither list, such
+# as an alias, is assumed to change them.
+_REF_READ_CMDS = {
+    "apply", "blame", "cat-file", "check-attr", "check-ignore",
+    "check-ref-format", "cherry", "clean", "commit-tree", "config",
+    "count-objects", "describe", "diff", "diff-files", "diff-index",
+    "diff-tree", "for-each-ref", "format-patch", "grep", "hash-object",
+    "interpret-trailers", "log", "ls-files", "ls-remote", "ls-tree",
+    "mailinfo", "mailsplit", "merge-base", "merge-tree", "mktag", "mktree",
+    "name-rev", "patch-id", "range-diff", "read-tree", "request-pull",
+    "rev-list", "rev-parse", "send-email", "shortlog", "show", "show-ref",
+    "status", "update-index", "var", "version", "write-tree"
+}
+
+# git options that come before the subcommand and take the next argument
+_GIT_ARG_OPTIONS = {
+    "-C", "-c", "--config-env", "--exec-path", "--git-dir", "--namespace",
+    "--super-prefix", "--work-tree"
+}
+
+
+def git_subcommand(argv):
+    """Return the subcommand of a git command line, or None"""
+    itr = iter(argv[1:])
+    for I in itr:
+        if I in _GIT_ARG_OPTIONS:
+            next(itr, None)
+        elif not I.startswith("-"):
+            return I
+    return None
+
+
+def may_update_refs(argv):
+    """True if running argv could change any refs"""
+    if not argv or os.path.basename(argv[0]) != "git":
+        return False
+    cmd = git_subcommand(argv)
+    if cmd in _REF_UPDATE_CMDS:
+        return True
+    return cmd not in _REF_READ_CMDS
+
+
+@contextmanager
+def trace_subprocess(argv):
+    """Context manager around running a subprocess that records it if
+    GJ_TRACE is enabled. The yielded TraceRecord can have its status,
+    stdout_bytes and note filled in, it is private to the caller even when
+    tracing is off. Every subprocess goes through here, so this is also where
+    git commands that can change refs throw away the RefSnapshots."""
+    update = may_update_refs(argv)
+    if update:
+        invalidate_ref_snapshots()
+    try:
+        if _trace is None:
+            yield TraceRecord([])
+        else:
+            with _trace.record(argv) as rec:
+                yield rec
+    finally:
+        # Another thread may have taken a snapshot while it ran
+        if update:
+            invalidate_ref_snapshots()
+
+
+@contextmanager
+def trace_request(argv):
+    """Context manager around one request to a long running subprocess, eg a
+    batch of names written to git cat-file. GJ_TRACE records it as a request,
+    not as a subprocess. The yielded TraceRecord can have its objects,
+    stdout_bytes and note filled in."""
+    if _trace is None:
+        yield TraceRecord([])
+        return
+    with _trace.record(argv, "request") as rec:
+        yield rec
+
+
+def traced_call(args, **kwargs):
+    """subprocess.check_call() that is recorded by GJ_TRACE"""
+    with trace_subprocess(args):
+        return subprocess.check_call(args, **kwargs)
+
+
+def traced_output(args, **kwargs):
+    """subprocess.check_output() that is recorded by GJ_TRACE"""
+    with trace_subprocess(args) as rec:
+        o = subprocess.check_output(args, **kwargs)
+        rec.stdout_bytes = len(o)
+    return o
+
+
+def traced_exec(args):
+    """os.execvp() that is recorded by GJ_TRACE. atexit does not run across
+    exec so the trace report is produced first."""
+    if _trace is not None:
+        with _trace.record(args) as rec:
+            rec.note = "exec"
+        _trace.report()
+    os.execvp(args[0], args)
+
+
 def git_call(args):
     """Run git and display the output to the terminal"""
-    return subprocess.check_call([
+    return traced_call([
         'git',
     ] + args)
 
 def git_exec(args):
     """Run git and display the output to the terminal, does not return"""
-    os.execvp("git", ["git"] + args)
+    traced_exec(["git"] + args)
 
 
 def git_output(args, mode=None, null_stderr=False, input=None, env=None):
     """Run git and return the output"""
     if null_stderr:
         with open("/dev/null") as F:
-            o = subprocess.check_output(['git'] + args,
-                                        stderr=F,
-                                        input=input,
-                                        env=env)
+            o = traced_output(['git'] + args,
+                              stderr=F,
+                              input=input,
+                              env=env)
     else:
-        o = subprocess.check_output(['git'] + args, input=input, env=env)
+        o = traced_output(['git'] + args, input=input, env=env)
     if mode == "raw":
         return o
     elif mode == "lines":
@@ -67,7 +326,7 @@ def git_output(args, mode=None, null_stderr=False, input=None, env=None):
 
 def git_output_to_file(args, file):
     """Run git and send the output to a file"""
-    return subprocess.check_call([
+    return traced_call([
         'git',
     ] + args, stdout=file)
 
@@ -92,6 +351,31 @@ def git_output_id(args, mode=None, input=None, env=None):
     return git_norm_id(git_output(args, mode, input=input, env=env))
 
 
+def git_map(fn, items, max_workers=None):
+    """Like map(), but fn is called for each item concurrently from a bounded
+    pool of threads. This is for running independent git queries, the results
+    are yielded in the same order as items and if fn raises the exception is
+    raised when its result is reached, just as map() would.
+
+    The threads share the current directory, so fn must not chdir."""
+    items = list(items)
+    if len(items) <= 1:
+        yield from map(fn, items)
+        return
+
+    if max_workers is None:
+        max_workers = min(16, os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(max_workers, len(items))) as pool:
+        yield from pool.map(fn, items)
+
+
+def git_output_many(args_list, **kwargs):
+    """Run git_output() for each list of arguments concurrently and return the
+    list of outputs"""
+    return list(git_map(lambda args: git_output(args, **kwargs), args_list))
+
+
 def git_ref_add_suffix(revish, suffix):
     """Append a suffix to a rev-parse argument, get ^{commit} or similar. If
     necessary this converts revish to a proper rev before doing so."""
@@ -105,6 +389,12 @@ def git_ref_add_suffix(revish, suffix):
 
 def git_ref_id(thing, fail_is_none=False):
     """Return the git ID for a ref or None"""
+    res = git_backend().ref_id(thing)
+    if res is not None:
+        return res
+    res = snapshot_ref_id(thing)
+    if res is not None:
+        return res[0]
     try:
         o = git_output(["rev-parse", thing], null_stderr=True)
     except subprocess.CalledProcessError:
@@ -117,10 +407,39 @@ def git_ref_id(thing, fail_is_none=False):
 def git_commit_id(thing, fail_is_none=False):
     """Returns a commit ID for thing. If thing is a tag or something then it is
     converted to an object ID"""
+    res = git_backend().commit_id(thing)
+    if res is not None:
+        return res
+    res = snapshot_ref_id(thing)
+    if res is not None and res[1] == "commit":
+        return res[0]
     return git_ref_id(git_ref_add_suffix(thing, "^{commit}"),
                       fail_is_none=fail_is_none)
 
 
+def git_commit_ids(things):
+    """Like git_commit_id() for a list of things, anything that cannot be
+    resolved without git is handled by a single rev-parse"""
+    res = []
+    todo = []
+    for I in things:
+        cid = git_backend().commit_id(I)
+        if cid is None:
+            cid = snapshot_ref_id(I)
+            cid = cid[0] if cid is not None and cid[1] == "commit" else None
+        if cid is None:
+            todo.append(len(res))
+        res.append(cid)
+    if todo:
+        o = git_output(["rev-parse"] +
+                       [git_ref_add_suffix(things[I], "^{commit}") for I in todo],
+                       mode="lines")
+        assert len(o) == len(todo)
+        for idx, cid in zip(todo, o):
+            res[idx] = git_norm_id(cid)
+    return res
+
+
 def git_root():
     """Return the top of the source directory we are currently in"""
     res = git_output(
@@ -151,14 +470,143 @@ def git_root():
     raise ValueError("Not a git directory")
 
 
+_common_dirs = {}
+
+
+def git_common_dir():
+    """Return the absolute path to the git directory shared by all worktrees
+    of the repository we are currently in"""
+    cdir = os.getcwd()
+    with _state_lock:
+        res = _common_dirs.get(cdir)
+    if res is None:
+        res = git_output(["rev-parse", "--git-common-dir"]).decode()
+        res = os.path.normpath(os.path.join(cdir, res))
+        with _state_lock:
+            _common_dirs[cdir] = res
+    return res
+
+
 GitObject = collections.namedtuple("GitObject", "keys raw_keys desc")
 
 
-def git_read_object(obj_type, idish):
-    """Return the raw git internal object such as a commit or tag,
-    processing out the header."""
-    lines = git_output(["cat-file", obj_type, idish], mode="lines")
+class GitCatFile(object):
+    """A long running 'git cat-file --batch' process. Object names are written
+    to stdin and git replies with a header line followed by the raw object for
+    each name, in order."""
+    # Replies are read after this many names are written, this keeps the
+    # request small enough to fit in the stdin pipe buffer so we never block
+    # writing while git is blocked on a full stdout pipe.
+    max_pipeline = 256
+
+    def __init__(self, cwd=None):
+        with trace_subprocess(["git", "cat-file", "--batch"]) as rec:
+            rec.note = "started"
+            self.proc = subprocess.Popen(["git", "cat-file", "--batch"],
+                                         cwd=cwd,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        # Serializes requests from git_map() threads
+        self.lock = threading.Lock()
+
+    def detach(self):
+        """Close our ends of the pipes without waiting for git, after fork
+        when another process is using it"""
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc = None
+
+    def close(self):
+        with self.lock:
+            if self.proc is None:
+                return
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self.proc.wait()
+            self.proc.stdout.close()
+            self.proc = None
+
+    def _read_reply(self):
+        hdr = self.proc.stdout.readline()
+        if not hdr:
+            raise BrokenPipeError("git cat-file exited")
+        g = re.match(rb"^[0-9a-fA-F]{40} (\S+) (\d+)$", hdr.rstrip(b"\n"))
+        if g is None:
+            # '<name> missing' or '<name> ambiguous'
+            return None
+        size = int(g.group(2))
+        data = self.proc.stdout.read(size + 1)
+        if len(data) != size + 1:
+            raise BrokenPipeError("git cat-file exited")
+        return (g.group(1).decode(), data[:-1])
+
+    def read_objects(self, names):
+        """Return a list of (type, raw) tuples for each object name, or None
+        if git could not find the name."""
+        names = [I if isinstance(I, bytes) else I.encode() for I in names]
+        for I in names:
+            if b"\n" in I:
+                raise ValueError("Bad object name %r" % (I))
+
+        res = []
+        with self.lock:
+            if self.proc is None:
+                raise BrokenPipeError("git cat-file was closed")
+            for idx in range(0, len(names), self.max_pipeline):
+                chunk = names[idx:idx + self.max_pipeline]
+                with trace_request(["git", "cat-file", "--batch"]) as rec:
+                    rec.objects = len(chunk)
+                    self.proc.stdin.write(b"".join(I + b"\n" for I in chunk))
+                    self.proc.stdin.flush()
+                    replies = [self._read_reply() for I in chunk]
+                    rec.stdout_bytes = sum(
+                        len(I[1]) for I in replies if I is not None)
+                res.extend(replies)
+        return res
+
+
+# Protects the per-directory state below from git_map() threads
+_state_lock = threading.RLock()
+
+# One cat-file process for each directory we have read objects from, None
+# means the process failed and we use the slow path from then on.
+_cat_files = {}
+
+
+def git_cat_file():
+    """Return the GitCatFile for the current directory, or None"""
+    cdir = os.getcwd()
+    with _state_lock:
+        if cdir not in _cat_files:
+            _cat_files[cdir] = GitCatFile()
+        return _cat_files[cdir]
+
+
+def close_cat_file(cdir=None, failed=False):
+    """Stop the cat-file process for a directory. If failed is set then the
+    slow path is used for future reads from that directory."""
+    if cdir is None:
+        cdir = os.getcwd()
+    with _state_lock:
+        cat_file = _cat_files.pop(cdir, None)
+        if failed:
+            _cat_files[cdir] = None
+    if cat_file is not None:
+        cat_file.close()
+
+
+@atexit.register
+def _close_all_cat_files():
+    for I in list(_cat_files.keys()):
+        close_cat_file(I)
+
 
+def parse_object(lines):
+    """Convert the lines of a raw git commit or tag into a GitObject,
+    processing out the header."""
     # Read the key/values from the control block
     keys = []
     itr = iter(lines)
@@ -190,12 +638,49 @@ def git_read_object(obj_type, idish):
     return GitObject(keys=dkeys, raw_keys=keys, desc=desc)
 
 
-def git_trailers(commit):
-    """Return a list of trailers from a commit message"""
+def git_read_objects(obj_type, idishes):
+    """Return a list of GitObjects for every idish. The objects are read in
+    bulk using the persistent cat-file process."""
+    idishes = list(idishes)
+    raws = git_backend().read_objects(obj_type, idishes)
+    missing = [idx for idx, raw in enumerate(raws) if raw is None]
+    cat_file = git_cat_file() if missing else None
+    if cat_file is not None:
+        try:
+            for idx, raw in zip(
+                    missing,
+                    cat_file.read_objects([
+                        git_ref_add_suffix(idishes[I], "^{%s}" % (obj_type))
+                        for I in missing
+                    ])):
+                raws[idx] = raw
+        except (OSError, ValueError):
+            close_cat_file(failed=True)
+
+    res = []
+    for idish, raw in zip(idishes, raws):
+        if raw is None:
+            # Let git produce the error, or handle whatever the batch
+            # interface could not.
+            lines = git_output(["cat-file", obj_type, idish], mode="lines")
+        else:
+            assert raw[0] == obj_type
+            lines = raw[1].splitlines()
+        res.append(parse_object(lines))
+    return res
+
+
+def git_read_object(obj_type, idish):
+    """Return the raw git internal object such as a commit or tag,
+    processing out the header."""
+    return git_read_objects(obj_type, [idish])[0]
+
+
+def parse_trailers(lines):
+    """Convert the output of %(trailers:only,unfold) into a list of (key,
+    value) tuples"""
     res = []
-    for I in git_output(
-        ["show", "--no-patch", "--pretty=%(trailers:only,unfold)", commit],
-            mode="lines"):
+    for I in lines:
         if not I.strip():
             continue
         I = I.partition(b":")
@@ -203,6 +688,116 @@ def git_trailers(commit):
     return res
 
 
+def git_trailers_map(commits):
+    """Return a dict of commit ID to the list of trailers from its commit
+    message. commits is either a list of commits or a GitRange, all the
+    trailers are read with a single git log."""
+    args = [
+        "log", "--no-show-signature",
+        "--format=%H%x00%(trailers:only,unfold)%x1e"
+    ]
+    if isinstance(commits, GitRange):
+        args.extend(commits.rev_range())
+    else:
+        commits = list(commits)
+        if not commits:
+            return {}
+        args.append("--no-walk=unsorted")
+        args.extend(commits)
+
+    res = {}
+    for I in git_output(args, mode="raw").split(b"\x1e"):
+        I = I.lstrip(b"\n")
+        if not I:
+            continue
+        commit, _, trailers = I.partition(b"\0")
+        res[git_norm_id(commit)] = parse_trailers(trailers.splitlines())
+    return res
+
+
+def git_trailers(commit):
+    """Return a list of trailers from a commit message"""
+    res = git_trailers_map([commit])
+    assert len(res) == 1
+    return list(res.values())[0]
+
+
+class GitObjectWriter(object):
+    """Write many objects to the object store with a few git processes.
+    Object IDs are computed locally when the object is added, so objects that
+    refer to each other can be built before anything is written. flush()
+    stores everything with one 'git hash-object --stdin-paths' per object
+    type and checks git agrees with the IDs we computed."""
+
+    def __init__(self):
+        self.pending = collections.defaultdict(dict)
+
+    @staticmethod
+    def object_id(obj_type, data):
+        h = hashlib.sha1(b"%s %u\0" % (obj_type.encode(), len(data)))
+        h.update(data)
+        return h.hexdigest()
+
+    def add(self, obj_type, data):
+        """Queue an object of obj_type ('blob', 'tree', 'commit', 'tag') and
+        return its object ID"""
+        oid = self.object_id(obj_type, data)
+        self.pending[obj_type][oid] = data
+        return oid
+
+    def add_tree(self, entries):
+        """Queue a tree object made from a list of (mode, name, object ID),
+        mode is eg '100644' or '40000' for a sub tree"""
+
+        entries = [(mode.encode(),
+                    name if isinstance(name, bytes) else name.encode(), oid)
+                   for mode, name, oid in entries]
+
+        def sort_key(entry):
+            mode, name, _ = entry
+            return name + b"/" if mode == b"40000" else name
+
+        data = []
+        for mode, name, oid in sorted(entries, key=sort_key):
+            data.append(b"%s %s\0" % (mode, name) + bytes.fromhex(oid))
+        return self.add("tree", b"".join(data))
+
+    def flush(self):
+        if not self.pending:
+            return
+        with tempfile.TemporaryDirectory() as dirname:
+            for obj_type, objs in self.pending.items():
+                fns = []
+                for oid, data in objs.items():
+                    fn = os.path.join(dirname, oid)
+                    with open(fn, "wb") as F:
+                        F.write(data)
+                    fns.append(fn)
+                # The data is the object, it must not go through the
+                # autocrlf and .gitattributes filters. Trees and commits we
+                # built ourselves are not checked again for being well formed.
+                cmd = ["hash-object", "-w", "-t", obj_type, "--no-filters"]
+                if obj_type != "blob":
+                    cmd.append("--literally")
+                res = git_output(
+                    cmd + ["--stdin-paths"],
+                    mode="lines",
+                    input="\n".join(fns).encode())
+                if [git_norm_id(I) for I in res] != list(objs.keys()):
+                    raise ValueError("git disagrees on %s object IDs" %
+                                     (obj_type))
+        self.pending.clear()
+
+
+@contextmanager
+def git_object_writer():
+    """Yield a GitObjectWriter, the objects are written when the context
+    closes without an exception"""
+    writer = GitObjectWriter()
+    yield writer
+    writer.flush()
+
+
 def extract_date(s):
     """Return the date in gmtime from an internal git date string of 1514090852 -0800"""
     g = re.match(rb".* (\d+) ([+-])(\d\d)(\d\d)", s)
@@ -214,32 +809,517 @@ def extract_date(s):
     return datetime.datetime.fromtimestamp(int(g.group(1)), tz)
 
 
+class WorktreePool(object):
+    """A few detached worktrees kept in the common git directory for reuse.
+    A worktree is leased by holding a flock on its lock file. Since the index
+    of a reused worktree matches its checkout, moving it to a new commit only
+    touches the files that differ, and ignored build output and the build-*
+    directories are kept so builds in it are incremental. size overrides the
+    configured number of worktrees to lease from, worktrees beyond it are
+    still kept while they hold state."""
+    dirname = "gj-worktrees"
+    # Untracked directories at the top of a worktree that survive reuse. A
+    # build directory here is at the same place relative to the source as in
+    # the main checkout, so ccache sees the same relative paths.
+    keep = ("build-*", )
+
+    def __init__(self, size=None):
+        from . import config
+
+        self.path = os.path.join(git_common_dir(), self.dirname)
+        self.size = size or config.worktree_pool_size
+        self.max_age = config.worktree_pool_max_age * 24 * 60 * 60
+        os.makedirs(self.path, exist_ok=True)
+
+    def _try_lock(self, name):
+        F = open(os.path.join(self.path, name + ".lock"), "a")
+        try:
+            fcntl.flock(F, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            F.close()
+            return None
+        return F
+
+    def _is_worktree(self, dfn):
+        return os.path.isfile(os.path.join(dfn, ".git"))
+
+    def _remove(self, dfn):
+        if self._is_worktree(dfn):
+            git_call(["worktree", "remove", "--force", dfn])
+        elif os.path.exists(dfn):
+            shutil.rmtree(dfn)
+
+    def _state(self, names, fn):
+        """The files kept alongside worktree fn"""
+        return [
+            I for I in names
+            if I.startswith(fn + ".") and I != fn + ".lock"
+        ]
+
+    def _has_kept(self, dfn):
+        return any(glob.glob(os.path.join(dfn, I)) for I in self.keep)
+
+    def gc(self):
+        """Remove worktrees that are not in use and have not been used
+        recently, or are beyond the pool size and have nothing kept alongside
+        them. A larger pool used by one command keeps its build directories
+        when the default size pool is leased from."""
+        now = time.time()
+        removed = False
+        names = os.listdir(self.path)
+        for fn in names:
+            g = re.match(r"^wt-(\d+)$", fn)
+            if g is None:
+                continue
+            lock_fn = os.path.join(self.path, fn + ".lock")
+            try:
+                stale = now - os.stat(lock_fn).st_mtime > self.max_age
+            except FileNotFoundError:
+                stale = True
+            if not stale and (int(g.group(1)) < self.size
+                              or self._state(names, fn)
+                              or self._has_kept(os.path.join(self.path, fn))):
+                continue
+            F = self._try_lock(fn)
+            if F is None:
+                continue
+            with F:
+                self._remove(os.path.join(self.path, fn))
+                for I in self._state(os.listdir(self.path), fn):
+                    shutil.rmtree(os.path.join(self.path, I))
+                os.unlink(lock_fn)
+            removed = True
+        if removed:
+            git_call(["worktree", "prune"])
+
+    def _reset(self, dfn):
+        """Discard whatever the last user left behind. This uses git -C so
+        leases can be taken from several threads."""
+        gdir = git_output(["-C", dfn, "rev-parse",
+                           "--absolute-git-dir"]).decode()
+        if os.path.exists(os.path.join(gdir, "rebase-apply")):
+            git_call(["-C", dfn, "am", "--abort"])
+        if os.path.exists(os.path.join(gdir, "MERGE_HEAD")):
+            git_call(["-C", dfn, "merge", "--abort"])
+        if os.path.exists(os.path.join(gdir, "index")):
+            git_call(["-C", dfn, "reset", "-q", "--hard"])
+        excludes = []
+        for I in self.keep:
+            excludes.extend(["-e", "/" + I])
+        git_call(["-C", dfn, "clean", "-q", "-f", "-d"] + excludes)
+
+    @contextmanager
+    def lease(self):
+        """Yield the path to an idle worktree, or None if all are busy. Files
+        named after the worktree with a suffix, eg wt-0.log, are removed
+        along with it, callers can keep related state there or in the keep
+        directories inside it."""
+        self.gc()
+        for idx in range(self.size):
+            name = "wt-%u" % (idx)
+            F = self._try_lock(name)
+            if F is None:
+                continue
+            with F:
+                os.utime(F.name)
+                dfn = os.path.join(self.path, name)
+                if self._is_worktree(dfn):
+                    self._reset(dfn)
+                else:
+                    self._remove(dfn)
+                    git_call(["worktree", "add", "--detach", "--no-checkout", dfn])
+                yield dfn
+            return
+        yield None
+
+
 @contextmanager
-def git_temp_worktree():
+def git_temp_worktree(pooled=False):
     """Context manager that creates a temporary work tree and chdirs into it.  The
-    worktree is deleted when the contex manager is closed"""
+    worktree is deleted when the contex manager is closed. If pooled then an
+    idle worktree from the WorktreePool is used instead, the caller must not
+    assume anything about its starting HEAD or checkout."""
+    if pooled:
+        with WorktreePool().lease() as dfn:
+            if dfn is not None:
+                with in_directory(dfn):
+                    try:
+                        yield
+                    finally:
+                        close_cat_file()
+                return
+
     dfn = None
     try:
         with tempfile.TemporaryDirectory() as dfn:
             git_call(["worktree", "add", "--detach", "--no-checkout", dfn])
             with in_directory(dfn):
-                yield
+                try:
+                    yield
+                finally:
+                    close_cat_file()
     finally:
         if dfn is not None:
             git_call(["worktree", "remove", dfn])
 
 
+ToListRef = collections.namedtuple("ToListRef", "refname date version")
+
+
+class RefSnapshot(object):
+    """All the refs in the repository, read with a single for-each-ref. Refs
+    are indexed so that prefix and ref name lookups do not need to run
+    git."""
+    # Names we can resolve directly, anything else is a rev-parse expression
+    PLAINRE = rb"^[A-Za-z0-9_][A-Za-z0-9_./+-]*$"
+    TOLISTRE = rb"^refs/heads/to-list/(\d+-\d+-\d+)/([^/]+)/(\d+)$"
+
+    def __init__(self):
+        # refname -> (object ID, object type)
+        self.refs = {}
+        for I in git_output([
+                "for-each-ref",
+                "--format=%(refname)%00%(objectname)%00%(objecttype)"
+        ],
+                            mode="lines"):
+            refname, oid, otype = I.split(b"\0")
+            self.refs[refname] = (git_norm_id(oid), otype.decode())
+        self.sorted_refs = sorted(self.refs.keys())
+
+        # series name -> list of ToListRef for the branches 'gj send' makes,
+        # sorted by version and then date. The same version can have been
+        # sent on several dates.
+        self.to_list = collections.defaultdict(list)
+        for I in self.with_prefix(b"refs/heads/to-list/"):
+            g = re.match(self.TOLISTRE, I)
+            if g is None:
+                continue
+            date = datetime.datetime.strptime(g.group(1).decode(), "%Y-%m-%d")
+            self.to_list[g.group(2).decode()].append(
+                ToListRef(refname=I, date=date, version=int(g.group(3))))
+        for I in self.to_list.values():
+            I.sort(key=lambda x: (x.version, x.date))
+
+    @classmethod
+    def is_plain(cls, name):
+        """True if name is a simple ref name and not an object ID or a more
+        complex revision expression"""
+        if isinstance(name, str):
+            name = name.encode()
+        return (re.match(cls.PLAINRE, name) is not None and b".." not in name
+                and re.match(IDRE, name) is None)
+
+    def with_prefix(self, prefix):
+        """Return a sorted list of refnames starting with prefix, eg
+        b'refs/remotes/'"""
+        if isinstance(prefix, str):
+            prefix = prefix.encode()
+        res = []
+        for I in self.sorted_refs[bisect.bisect_left(self.sorted_refs,
+                                                     prefix):]:
+            if not I.startswith(prefix):
+                break
+            res.append(I)
+        return res
+
+    def ref_id(self, name):
+        """Return (object ID, object type) for name following the same search
+        rules as rev-parse, or None if name is not something we can resolve
+        without git."""
+        if not self.is_plain(name):
+            return None
+        if isinstance(name, str):
+            name = name.encode()
+        for fmt in [
+                b"%s", b"refs/%s", b"refs/tags/%s", b"refs/heads/%s",
+                b"refs/remotes/%s", b"refs/remotes/%s/HEAD"
+        ]:
+            res = self.refs.get(fmt % (name))
+            if res is not None:
+                return res
+        return None
+
+
+# The RefSnapshot for each directory we have looked at refs in
+_ref_snapshots = {}
+
+
+def git_ref_snapshot():
+    """Return the RefSnapshot for the current directory, it is created on
+    first use and kept until a command that can change refs is run."""
+    cdir = os.getcwd()
+    with _state_lock:
+        res = _ref_snapshots.get(cdir)
+        if res is None:
+            res = _ref_snapshots[cdir] = RefSnapshot()
+        return res
+
+
+def invalidate_ref_snapshots():
+    with _state_lock:
+        _ref_snapshots.clear()
+
+
+def snapshot_ref_id(name):
+    """Return (object ID, object type) for name from the RefSnapshot, or None
+    if it has to be resolved by git."""
+    if not RefSnapshot.is_plain(name):
+        return None
+    try:
+        return git_ref_snapshot().ref_id(name)
+    except subprocess.CalledProcessError:
+        return None
+
+
+class GitBackend(object):
+    """The read only primitives that can be answered without running git.
+    Every method returns None if it cannot answer, and the caller then falls
+    back to the git CLI. This base class answers nothing."""
+    name = "cli"
+
+    def ref_id(self, thing):
+        return None
+
+    def commit_id(self, thing):
+        return None
+
+    def read_objects(self, obj_type, idishes):
+        """Return a list of (type, raw) tuples, or None for each idish"""
+        return [None] * len(idishes)
+
+    def merge_base(self, commits):
+        return None
+
+    def is_ancestor(self, ancestor, commit):
+        return None
+
+
+class Pygit2Backend(GitBackend):
+    """Answer the read only primitives in-process using libgit2. merge-base is
+    left to git, when there are several equally good merge bases libgit2 does
+    not pick the same one as git."""
+    name = "pygit2"
+
+    def __init__(self, pygit2):
+        self.pygit2 = pygit2
+        path = pygit2.discover_repository(os.getcwd())
+        if path is None:
+            raise ValueError("Not a git directory")
+        self.repo = pygit2.Repository(path)
+        # libgit2 objects must not be used by several threads at once
+        self.lock = threading.Lock()
+        self.types = {
+            "commit": pygit2.Commit,
+            "tag": pygit2.Tag,
+            "tree": pygit2.Tree,
+            "blob": pygit2.Blob
+        }
+
+    def _lookup(self, thing):
+        if isinstance(thing, bytes):
+            thing = thing.decode()
+        # libgit2 does not search the same way as git for :/ and ^{/}, and
+        # has no idea about @{upstream} and similar.
+        if ":" in thing or "{/" in thing or "@" in thing:
+            return None
+        try:
+            return self.repo.revparse_single(thing)
+        except (KeyError, ValueError, self.pygit2.GitError):
+            return None
+
+    def _peel(self, obj, obj_type):
+        if obj is None:
+            return None
+        if obj.type_str == obj_type:
+            return obj
+        try:
+            return obj.peel(self.types[obj_type])
+        except (KeyError, ValueError, self.pygit2.GitError):
+            return None
+
+    def ref_id(self, thing):
+        with self.lock:
+            obj = self._lookup(thing)
+            if obj is None:
+                return None
+            return str(obj.id)
+
+    def commit_id(self, thing):
+        with self.lock:
+            obj = self._peel(self._lookup(thing), "commit")
+            if obj is None:
+                return None
+            return str(obj.id)
+
+    def read_objects(self, obj_type, idishes):
+        res = []
+        with self.lock:
+            for I in idishes:
+                obj = self._peel(self._lookup(I), obj_type)
+                res.append(None if obj is None else (obj_type,
+                                                     obj.read_raw()))
+        return res
+
+    def is_ancestor(self, ancestor, commit):
+        with self.lock:
+            ancestor = self._peel(self._lookup(ancestor), "commit")
+            commit = self._peel(self._lookup(commit), "commit")
+            if ancestor is None or commit is None:
+                return None
+            if ancestor.id == commit.id:
+                return True
+            return self.repo.descendant_of(commit.id, ancestor.id)
+
+
+def make_git_backend():
+    """Choose the backend according to GJ_GIT_BACKEND or config.git_backend"""
+    from . import config
+
+    kind = os.environ.get("GJ_GIT_BACKEND", config.git_backend)
+    if kind == "cli":
+        return GitBackend()
+    if kind not in ("auto", "pygit2"):
+        raise ValueError("Bad git backend %r" % (kind))
+    try:
+        import pygit2
+    except ImportError:
+        if kind == "pygit2":
+            raise
+        return GitBackend()
+    try:
+        return Pygit2Backend(pygit2)
+    except ValueError:
+        pass
+    except pygit2.GitError:
+        # libgit2 cannot open every repository git can, eg ones using
+        # extensions it does not know about
+        if kind == "pygit2":
+            raise
+    return GitBackend()
+
+
+# The backend used for each directory
+_backends = {}
+
+
+def git_backend():
+    """Return the GitBackend for the current directory"""
+    cdir = os.getcwd()
+    with _state_lock:
+        res = _backends.get(cdir)
+        if res is None:
+            res = _backends[cdir] = make_git_backend()
+        return res
+
+
+def reset_after_fork(cat_files=None):
+    """Called in a child forked from a process that has used this module, eg
+    the gj daemon. Pipes to processes started by the parent cannot be shared
+    so those are dropped, while the ref snapshot, which is the same for every
+    worktree, is moved to the new current directory. cat_files maps
+    directories to GitCatFiles the parent started for this child alone, they
+    are used instead of starting new ones."""
+    global _trace
+
+    with _state_lock:
+        for cat_file in _cat_files.values():
+            if cat_file is not None:
+                cat_file.detach()
+        _cat_files.clear()
+        _cat_files.update(cat_files or {})
+        _backends.clear()
+        _common_dirs.clear()
+        snapshots = list(_ref_snapshots.values())
+        _ref_snapshots.clear()
+        if snapshots:
+            _ref_snapshots[os.getcwd()] = snapshots[0]
+
+    if _trace is not None:
+        _trace.reported = True
+        _trace = None
+    if os.environ.get("GJ_TRACE"):
+        _trace = SubprocessTrace(os.environ["GJ_TRACE"])
+
+
+def git_merge_base(commits):
+    """Return the merge base of the first commit and all the others"""
+    res = git_backend().merge_base(commits)
+    if res is not None:
+        return res
+    return git_output_id(["merge-base"] + list(commits))
+
+
+def git_is_ancestor(ancestor, commit):
+    """True if ancestor is an ancestor of commit"""
+    res = git_backend().is_ancestor(ancestor, commit)
+    if res is not None:
+        return res
+    try:
+        traced_call(["git", "merge-base", "--is-ancestor", ancestor, commit])
+        return True
+    except subprocess.CalledProcessError as ex:
+        if ex.returncode != 1:
+            raise
+        return False
+
+
+def git_merge_tree(ours, theirs):
+    """Merge two commits in memory without a worktree. Returns the tree ID of
+    the result and a list of the conflicted paths, the tree contains conflict
+    markers if the list is not empty."""
+    try:
+        o = git_output([
+            "merge-tree", "--write-tree", "--name-only", "--no-messages",
+            "-z", ours, theirs
+        ],
+                       mode="raw")
+    except subprocess.CalledProcessError as ex:
+        # Exit status 1 means the merge has conflicts
+        if ex.returncode != 1:
+            raise
+        o = ex.output
+    parts = [I for I in o.split(b"\0") if I]
+    return git_norm_id(parts[0]), parts[1:]
+
+
 def get_remote_branches():
     """Return the name of all remote branches"""
-    branches = git_output(
-        ["branch", "--all", "--list", "--format", '%(refname)'], mode="lines")
-    return set(I for I in branches if I.startswith(b"refs/remotes"))
+    return set(git_ref_snapshot().with_prefix(b"refs/remotes/"))
+
+
+# author and committer are in the same form as the commit object header, eg
+# "Name <email> 1514090852 -0800", use extract_date() to get the date.
+# subject is the first paragraph of the message joined into one line, as git
+# log %s shows it, while first_line is only the first line
+GitCommit = collections.namedtuple(
+    "GitCommit",
+    "commit_id parents author committer subject first_line body trailers")
 
 
 class GitRange(object):
+    """The commits reachable from newest but not ancestor. The ends are
+    resolved to commit IDs on first use and anything computed from the range
+    is remembered, so the caller can ask for it repeatedly."""
+
     def __init__(self, newest, ancestor):
-        self.newest = git_commit_id(newest)
-        self.ancestor = git_commit_id(ancestor)
+        self._names = (newest, ancestor)
+        self._ids = None
+        self._commit_lists = {}
+        self._changed_files = None
+        self._commit_files = None
+
+    def _resolve(self):
+        if self._ids is None:
+            self._ids = git_commit_ids(list(self._names))
+        return self._ids
+
+    @property
+    def newest(self):
+        return self._resolve()[0]
+
+    @property
+    def ancestor(self):
+        return self._resolve()[1]
 
     def rev_range(self):
         return [self.newest, "^" + self.ancestor]
@@ -250,16 +1330,36 @@ class GitRange(object):
     def get_changed_files(self):
         """Return a list of all files that are different between the two treeish
         things. This is a straight up diff between the two points"""
-        diff = git_output(["diff-tree", "-r", self.newest, self.ancestor],
-                          mode="lines")
-        return [I.partition(b"\t")[2] for I in diff]
+        if self._changed_files is None:
+            diff = git_output(["diff-tree", "-r", self.newest, self.ancestor],
+                              mode="lines")
+            self._changed_files = [I.partition(b"\t")[2] for I in diff]
+        return list(self._changed_files)
+
+    def get_commit_files(self):
+        """Return a dict of commit ID to the list of files that commit touches
+        for every non-merge commit in the range, using a single git log"""
+        if self._commit_files is None:
+            out = git_output([
+                "log", "--no-merges", "--name-only", "--no-renames", "-z",
+                "--format=%x01%H"
+            ] + self.rev_range(),
+                             mode="raw")
+            res = {}
+            for I in out.split(b"\x01")[1:]:
+                parts = I.split(b"\0")
+                res[git_norm_id(parts[0])] = [
+                    J.lstrip(b"\n") for J in parts[1:] if J.lstrip(b"\n")
+                ]
+            self._commit_files = res
+        return {k: list(v) for k, v in self._commit_files.items()}
 
     def get_commit_changed_files(self):
         """Look at each commit in the range and combine the list of files it
         touches"""
         res = set()
-        for I in self.get_commit_list(extra_args=["--no-merges"]):
-            res.update(GitRange(I, I + "^").get_changed_files())
+        for files in self.get_commit_files().values():
+            res.update(files)
         return res
 
     def fork_gitk(self):
@@ -267,22 +1367,77 @@ class GitRange(object):
         subprocess.Popen(["gitk"] + self.rev_range(), close_fds=True)
 
     def get_commit_list(self, extra_args=[]):
-        ids = git_output(["rev-list"] + extra_args + self.rev_range(),
-                         mode="lines")
+        key = tuple(extra_args)
+        res = self._commit_lists.get(key)
+        if res is None:
+            ids = git_output(["rev-list"] + extra_args + self.rev_range(),
+                             mode="lines")
+            res = []
+            for I in ids:
+                assert re.match(IDRE, I)
+                res.append(I.decode())
+            self._commit_lists[key] = res
+        return list(res)
+
+    def count(self, limit=None):
+        """Return the number of commits in the range, counting stops at limit"""
+        res = self._commit_lists.get(())
+        if res is not None:
+            return len(res) if limit is None else min(len(res), limit)
+        args = ["rev-list", "--count"]
+        if limit is not None:
+            args.append("--max-count=%u" % (limit))
+        return int(git_output(args + self.rev_range()))
+
+    def load_commits(self, extra_args=[]):
+        """Return a GitCommit for every commit in the range, in the same order
+        as get_commit_list(). This uses a single git log."""
+        fields = [
+            "%H", "%P", "%an <%ae> %ad", "%cn <%ce> %cd", "%s", "%b",
+            "%(trailers:only,unfold)", "%B"
+        ]
+        out = git_output([
+            "log", "-z", "--no-show-signature", "--date=raw",
+            "--format=" + "%x00".join(fields)
+        ] + extra_args + self.rev_range(),
+                         mode="raw")
+        parts = out.split(b"\0")
+        if len(parts) % len(fields) == 1 and not parts[-1]:
+            del parts[-1]
+        assert len(parts) % len(fields) == 0
+
         res = []
-        for I in ids:
-            assert re.match(IDRE, I)
-            res.append(I.decode())
+        for idx in range(0, len(parts), len(fields)):
+            (commit_id, parents, author, committer, subject, body, trailers,
+             message) = parts[idx:idx + len(fields)]
+            res.append(
+                GitCommit(commit_id=git_norm_id(commit_id),
+                          parents=[git_norm_id(I) for I in parents.split()],
+                          author=author,
+                          committer=committer,
+                          subject=subject,
+                          first_line=message.split(b"\n", 1)[0],
+                          body=body,
+                          trailers=parse_trailers(trailers.splitlines())))
         return res
 
     def sanity_check(self):
         """Check if the number of commits in the range is unusually high,
         this usually indicates a user error."""
-        count = len(self.get_commit_list())
+        count = self.count(limit=100)
         if count >= 100:
             raise ValueError(
-                "Too many commits (%u) between %s ^%s probably a mistake" %
-                (count, self.newest, self.ancestor))
+                "Too many commits (%u or more) between %s ^%s probably a mistake"
+                % (count, self.newest, self.ancestor))
+
+
+def merge_base_key(head, references):
+    """The gj-cache key for the merge base of head and references, a hash of
+    the commit IDs so moving HEAD or any reference naturally misses"""
+    h = hashlib.sha1(head.encode())
+    for I in sorted(set(references)):
+        h.update(b"\0" + I.encode())
+    return h.hexdigest()
 
 
 def git_base_fewest_commits(references, head="HEAD"):
@@ -295,9 +1450,17 @@ def git_base_fewest_commits(references, head="HEAD"):
         references = get_remote_branches()
     assert references
 
-    # merge-base solves this problem automatically if the right bases are used
-    base = git_output_id(["merge-base", head] + [I for I in references])
-    return GitRange(head, base)
+    from .cache import cache_namespace
+
+    head_id = git_commit_id(head)
+    ref_ids = [git_commit_id(I) for I in references]
+    # merge-base solves this problem automatically if the right bases are
+    # used. Old results are aged out of the gj-cache once nothing asks for
+    # them.
+    base = cache_namespace("merge-base", 1).memoize(
+        merge_base_key(head_id, ref_ids),
+        lambda: git_merge_base([head_id] + sorted(set(ref_ids))))
+    return GitRange(head_id, base)
 
 
 def establish_ko_ssh(always_prompt=False):
@@ -305,8 +1468,7 @@ def establish_ko_ssh(always_prompt=False):
     from . import config
 
     try:
-        res = subprocess.check_output(
-            ["ssh", config.ko_ssh_server, "2fa", "isval"])
+        res = traced_output(["ssh", config.ko_ssh_server, "2fa", "isval"])
     except subprocess.CalledProcessError as ex:
         res = ex.output
 
@@ -333,31 +1495,282 @@ def git_push(remote, things=None, force=False):
     git_call(["push", remote] + things)
 
 
-def compile_test(dot_config, mfiles=None):
+def _read_sys(fn):
+    try:
+        with open(fn) as F:
+            return F.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_files(controller, fn):
+    """Yield the paths of fn for every cgroup level above this process, both
+    cgroup v2 and v1 layouts are tried"""
+    cgroups = _read_sys("/proc/self/cgroup") or ""
+    for ln in cgroups.splitlines():
+        hid, controllers, path = ln.split(":", 2)
+        if hid == "0":
+            top = "/sys/fs/cgroup"
+        elif controller in controllers.split(","):
+            top = os.path.join("/sys/fs/cgroup", controllers)
+        else:
+            continue
+        path = path.strip("/")
+        while True:
+            yield os.path.join(top, path, fn)
+            if not path:
+                break
+            path = os.path.dirname(path)
+
+
+def _cgroup_cpu_limit():
+    """The number of CPUs the cgroup quota allows, or None"""
+    res = None
+    for fn in _cgroup_files("cpu", "cpu.max"):
+        val = (_read_sys(fn) or "max").split()
+        if val[0] != "max":
+            res = min(res or 1 << 30, int(val[0]) / int(val[1]))
+    for fn in _cgroup_files("cpu", "cpu.cfs_quota_us"):
+        quota = int(_read_sys(fn) or -1)
+        if quota > 0:
+            period = int(_read_sys(fn.replace("quota", "period")) or 100000)
+            res = min(res or 1 << 30, quota / period)
+    if res is None:
+        return None
+    return max(1, int(res + 0.5))
+
+
+def _available_memory():
+    """Bytes of memory a build can use, the lower of the system's available
+    memory and any cgroup limit"""
+    res = None
+    for ln in (_read_sys("/proc/meminfo") or "").splitlines():
+        if ln.startswith("MemAvailable:"):
+            res = int(ln.split()[1]) * 1024
+    for limit_fn, usage_fn in [("memory.max", "memory.current"),
+                               ("memory.limit_in_bytes",
+                                "memory.usage_in_bytes")]:
+        for fn in _cgroup_files("memory", limit_fn):
+            limit = _read_sys(fn)
+            if limit is None or limit == "max" or int(limit) >= 1 << 60:
+                continue
+            usage = int(_read_sys(fn[:-len(limit_fn)] + usage_fn) or 0)
+            avail = max(0, int(limit) - usage)
+            res = avail if res is None else min(res, avail)
+    return res
+
+
+def _effective_cpus():
+    """Count the CPUs we can run on, weighting the efficiency cores of a
+    hybrid CPU as half a performance core"""
+    cpus = os.sched_getaffinity(0)
+    ecores = _read_sys("/sys/devices/cpu_atom/cpus")
+    if not ecores:
+        return len(cpus)
+    atoms = set()
+    for I in ecores.split(","):
+        lo, _, hi = I.partition("-")
+        atoms.update(range(int(lo), int(hi or lo) + 1))
+    return len(cpus - atoms) + len(cpus & atoms) // 2
+
+
+_jobs = None
+
+
+def get_jobs():
+    """Return the number of parallel compile jobs to run. This is
+    config.build_jobs if set, otherwise it is derived from the CPU topology,
+    any cgroup CPU quota and the memory available per job."""
+    global _jobs
+    from . import config
+
+    if config.build_jobs:
+        return config.build_jobs
+    if _jobs is not None:
+        return _jobs
+
+    jobs = _effective_cpus()
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        jobs = min(jobs, limit)
+    mem = _available_memory()
+    if mem is not None:
+        jobs = min(jobs, mem // (config.build_job_memory_mb * 1024 * 1024))
+    _jobs = max(1, jobs)
+    return _jobs
+
+
+def run_build(args, **kwargs):
+    """Run a build command copying its output to stdout while counting the
+    compiler warnings. Returns (exit status, warnings)"""
+    warnings = 0
+    with trace_subprocess(args) as rec:
+        proc = subprocess.Popen(args,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                **kwargs)
+        for ln in proc.stdout:
+            if b" warning: " in ln:
+                warnings += 1
+            sys.stdout.buffer.write(ln)
+            sys.stdout.buffer.flush()
+        proc.stdout.close()
+        status = proc.wait()
+        rec.status = status
+    return status, warnings
+
+
+class BuildLedger(object):
+    """Remember the result of building a source tree. The key is the tree ID
+    of the source along with any untracked files, a hash of the .config and
+    the make command with the identity of the compilers it names or of the
+    container image it runs in, so a known good build does not have to be
+    repeated. Trees with uncommitted changes are not recorded."""
+
+    def __init__(self):
+        from .cache import cache_namespace
+
+        self.ns = cache_namespace("build-ledger", 1)
+
+    @staticmethod
+    def source_tree(src, exclude=()):
+        """Return a string naming the files in src, the tree ID of HEAD and
+        the contents of any untracked files that are not ignored, or None if
+        any tracked file differs from HEAD. Paths matching the exclude
+        patterns, such as build directories, are not looked at."""
+        out = git_output(
+            ["-C", src, "status", "--porcelain", "-z", "--untracked-files=all",
+             "--"] + [":(exclude)" + I for I in exclude],
+            mode="raw")
+        untracked = []
+        for I in out.split(b"\0"):
+            if not I:
+                continue
+            if not I.startswith(b"?? "):
+                return None
+            untracked.append(I[3:])
+        tree = git_output(["-C", src, "rev-parse", "HEAD^{tree}"]).decode()
+        if not untracked:
+            return tree
+        untracked.sort()
+        ids = git_output(
+            ["-C", src, "hash-object", "--no-filters", "--stdin-paths"],
+            input=b"\n".join(untracked) + b"\n",
+            mode="raw")
+        h = hashlib.sha1(b"\0".join(untracked))
+        h.update(ids)
+        return "%s+%s" % (tree, h.hexdigest())
+
+    @staticmethod
+    def toolchain(cmd):
+        """The parts of a make command that affect the result, along with the
+        installed version of any program it names"""
+        res = []
+        itr = iter(cmd)
+        for I in itr:
+            if I == "-C":
+                next(itr, None)
+                continue
+            # Options that do not change the output, -i and -ti are from
+            # container exec
+            if I.startswith("-j") or I in ("-s", "-i", "-ti"):
+                continue
+            res.append(I)
+            for word in I.partition("=")[2].split():
+                path = shutil.which(word)
+                if path is not None:
+                    path = os.path.realpath(path)
+                    res.append("%s:%u" % (path, os.stat(path).st_mtime_ns))
+        return res
+
+    def key(self, src, dot_config, cmd, image_id=None, exclude=()):
+        """Return the key for building src with cmd, or None. image_id is the
+        ID of the container image cmd runs in, exclude is passed to
+        source_tree()"""
+        if not os.path.exists(dot_config):
+            return None
+        tree = self.source_tree(src, exclude)
+        if tree is None:
+            return None
+        h = hashlib.sha1()
+        with open(dot_config, "rb") as F:
+            h.update(F.read())
+        h.update("\0".join(self.toolchain(cmd)).encode())
+        if image_id is not None:
+            h.update(b"\0image\0" + image_id.encode())
+        return "%s %s" % (tree, h.hexdigest())
+
+    def lookup(self, key):
+        """Return the recorded result dict or None"""
+        if key is None:
+            return None
+        return self.ns.get(key)
+
+    def record(self, key, status, warnings, duration):
+        if key is None:
+            return
+        self.ns.put(
+            key,
+            dict(status=status,
+                 warnings=warnings,
+                 duration=duration,
+                 date=time.time()))
+
+    def report_hit(self, res):
+        print("Already built %s with %u warnings in %.0fs on %s, use --force to rebuild"
+              % ("successfully" if res["status"] == 0 else "FAILED",
+                 res["warnings"], res["duration"],
+                 time.strftime("%Y-%m-%d %H:%M",
+                               time.localtime(res["date"]))))
+
+
+def compile_test(dot_config, mfiles=None, force=False):
     """Run a compile test on a kernel tree"""
     from . import config
+    from .ccache import ccache_env, ccache_recorder
+    from .kbuild import host_arch
 
     make = [
         "make", "CC=" + config.compiler, "HOSTCC=" + config.compiler, "-s",
-        "-j8"
+        "-j%u" % (get_jobs())
     ]
+    env = ccache_env(".", ".")
     shutil.copyfile(dot_config, ".config")
-    subprocess.check_call(make + ["oldconfig"])
+    traced_call(make + ["oldconfig"], env=env)
+
+    ledger = BuildLedger()
+    key = ledger.key(".", ".config", make)
+    res = ledger.lookup(key)
+    if res is not None and res["status"] == 0 and not force:
+        ledger.report_hit(res)
+        return
+
     print("Running test compile using %r and %s" %
           (dot_config, config.compiler))
-
-    # If a list of modified files given then explicitly try and compile the .c
-    # files in the list first. This speeds up error detection and also serves
-    # to confirm we are compile testing every file we are touching as make
-    # will fail if there is no rule to make the .o file.
+    start = time.monotonic()
+    warnings = 0
+
+    # If a list of modified files given then explicitly try and compile the
+    # objects built from them first, using the dependencies recorded by the
+    # last build so that changed headers are covered too. This speeds up
+    # error detection and also serves to confirm we are compile testing every
+    # file we are touching as make will fail if there is no rule to make the
+    # .o file.
+    builds = []
     if mfiles is not None:
-        lst = set()
-        for I in mfiles:
-            if (I.endswith(b".c") and os.path.exists(I)
-                    and not I.startswith(b"tools/testing/")
-                    and not I.startswith(b"samples/")
-                    and not I.startswith(b"arch/")):
-                lst.add(I[:-2] + b".o")
-        subprocess.check_call(make + sorted(lst))
-
-    subprocess.check_call(make)
+        from .kbuild import changed_objects
+
+        objs = changed_objects(".", mfiles)
+        if objs:
+            builds.append(make + objs)
+    builds.append(make)
+
+    with ccache_recorder(".", host_arch(), "compile_test"):
+        for cmd in builds:
+            status, count = run_build(cmd, env=env)
+            warnings += count
+            if status:
+                ledger.record(key, status, warnings,
+                              time.monotonic() - start)
+                raise subprocess.CalledProcessError(status, cmd)
+    ledger.record(key, 0, warnings, time.monotonic() - start)
@@ -0,0 +1,394 @@
+"""Information about a kernel build directory taken from the .cmd files kbuild
+leaves next to every object"""
+import array
+import collections
+import json
+import os
+import pickle
+import re
+import shlex
+import tempfile
+
+# Objects under these directories cannot be built by naming them as a make
+# goal
+NO_SINGLE_TARGET = ("tools/", "samples/", "arch/", "scripts/", "usr/")
+
+
+# How the kernel's top level Makefile turns uname -m into ARCH
+SUBARCH_RES = [
+    (r"^i.86$", "x86"),
+    (r"^x86_64$", "x86"),
+    (r"^sun4u$", "sparc64"),
+    (r"^arm.*", "arm"),
+    (r"^sa110$", "arm"),
+    (r"^s390x$", "s390"),
+    (r"^ppc64.*", "powerpc"),
+    (r"^mips.*", "mips"),
+    (r"^sh[234].*", "sh"),
+    (r"^aarch64.*", "arm64"),
+    (r"^riscv.*", "riscv"),
+    (r"^loongarch.*", "loongarch"),
+]
+
+
+def host_arch():
+    """The kernel ARCH a build without ARCH= produces, eg x86 on x86_64"""
+    machine = os.uname().machine
+    for expr, arch in SUBARCH_RES:
+        if re.match(expr, machine):
+            return arch
+    return machine
+
+
+def single_target_ok(obj):
+    """True if obj can be built with 'make obj'"""
+    return not obj.startswith(NO_SINGLE_TARGET)
+
+
+def cmd_file_object(dirpath, fn, build_dir):
+    """Return the object name, relative to build_dir, that a .*.o.cmd file
+    describes or None"""
+    if not (fn.startswith(".") and fn.endswith(".o.cmd")):
+        return None
+    return os.path.relpath(os.path.join(dirpath, fn[1:-4]), build_dir)
+
+
+def parse_deps(fn):
+    """Return the list of inputs from the source_ and deps_ variables of a kbuild
+    .cmd file, as written. Config dependencies are not included."""
+    res = []
+    in_deps = False
+    with open(fn, "rt", errors="replace") as F:
+        for ln in F:
+            if in_deps:
+                ln = ln.strip()
+                cont = ln.endswith("\\")
+                ln = ln.rstrip("\\").strip()
+                if ln and not ln.startswith("$("):
+                    res.append(ln)
+                if not cont:
+                    in_deps = False
+                continue
+            if ln.startswith("source_"):
+                res.append(ln.partition(":=")[2].strip())
+            elif ln.startswith("deps_"):
+                in_deps = ln.rstrip().endswith("\\")
+    return res
+
+
+class DepIndex(object):
+    """Map files in the source tree to the objects in a kernel build directory
+    that are built from them. It is made from the source_ and deps_ lists kbuild
+    writes into every .*.o.cmd file and is stored in the build directory. Each
+    update only re-reads the .cmd files whose mtime changed."""
+    fn = ".gj-deps.pickle"
+    version = 2
+
+    def __init__(self, build_dir, src=None):
+        self.build_dir = os.path.abspath(build_dir)
+        self.src = os.path.abspath(src or os.getcwd())
+        self.path = os.path.join(self.build_dir, self.fn)
+        # Paths relative to src and object names are stored once in paths and
+        # names and referred to by index. objects maps the object name to
+        # (mtime_ns, array of path indexes) and users is the reverse, a path
+        # index to the indexes of the objects that depend on it. A users
+        # entry is an array until an update changes it, then it is a set.
+        self.paths = []
+        self.path_ids = {}
+        self.names = []
+        self.name_ids = {}
+        self.objects = {}
+        self.users = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as F:
+                data = pickle.load(F)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        if data.get("version") != self.version or data.get(
+                "src") != self.src:
+            return
+        self.paths = data["paths"]
+        self.path_ids = {I: idx for idx, I in enumerate(self.paths)}
+        self.names = data["names"]
+        self.name_ids = {I: idx for idx, I in enumerate(self.names)}
+        self.objects = data["objects"]
+        self.users = data["users"]
+
+    def save(self):
+        users = {
+            k: v if isinstance(v, array.array) else array.array(
+                "I", sorted(v))
+            for k, v in self.users.items() if v
+        }
+        try:
+            with tempfile.NamedTemporaryFile("wb",
+                                             dir=self.build_dir,
+                                             prefix=self.fn,
+                                             delete=False) as F:
+                pickle.dump(
+                    dict(version=self.version,
+                         src=self.src,
+                         paths=self.paths,
+                         names=self.names,
+                         objects=self.objects,
+                         users=users),
+                    F,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(F.name, self.path)
+        except OSError:
+            # The index is only an optimization
+            pass
+
+    def _path_id(self, fn):
+        """Return the index of a dependency, or None if it is not part of the
+        source tree"""
+        fn = os.path.normpath(os.path.join(self.build_dir, fn))
+        if (self.build_dir != self.src
+                and fn.startswith(self.build_dir + os.sep)):
+            return None
+        fn = os.path.relpath(fn, self.src)
+        if fn.startswith(".." + os.sep):
+            return None
+        res = self.path_ids.get(fn)
+        if res is None:
+            res = self.path_ids[fn] = len(self.paths)
+            self.paths.append(fn)
+        return res
+
+    def _name_id(self, obj):
+        res = self.name_ids.get(obj)
+        if res is None:
+            res = self.name_ids[obj] = len(self.names)
+            self.names.append(obj)
+        return res
+
+    def _users(self, path_id):
+        """Return the users entry of path_id as a set that can be changed"""
+        res = self.users.get(path_id)
+        if not isinstance(res, set):
+            res = self.users[path_id] = set(res or ())
+        return res
+
+    def _set_deps(self, obj, deps):
+        """Change the dependencies of obj, None removes it"""
+        oid = self._name_id(obj)
+        old = self.objects.pop(obj, None)
+        if old is not None:
+            for I in old[1]:
+                self._users(I).discard(oid)
+        if deps is not None:
+            self.objects[obj] = deps
+            for I in deps[1]:
+                self._users(I).add(oid)
+
+    def update(self):
+        """Bring the index up to date with the .cmd files in the build
+        directory"""
+        changed = False
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(self.build_dir):
+            if ".git" in dirnames:
+                dirnames.remove(".git")
+            for fn in filenames:
+                obj = cmd_file_object(dirpath, fn, self.build_dir)
+                if obj is None:
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                    old = self.objects.get(obj)
+                    seen.add(obj)
+                    if old is not None and old[0] == mtime:
+                        continue
+                    deps = parse_deps(path)
+                except OSError:
+                    continue
+                ids = (self._path_id(I) for I in deps)
+                self._set_deps(obj, (mtime,
+                                     array.array(
+                                         "I",
+                                         sorted(set(I for I in ids
+                                                    if I is not None)))))
+                changed = True
+
+        for obj in set(self.objects) - seen:
+            self._set_deps(obj, None)
+            changed = True
+        if changed:
+            self.save()
+        return self
+
+    def affected(self, changed_files):
+        """Return the objects that depend on any of changed_files, the ones
+        with the most changed inputs first"""
+        counts = collections.Counter()
+        for I in set(os.path.normpath(os.fsdecode(I)) for I in changed_files):
+            idx = self.path_ids.get(I)
+            if idx is not None:
+                counts.update(self.users.get(idx, ()))
+        res = sorted((-count, self.names[oid])
+                     for oid, count in counts.items())
+        return [obj for _, obj in res]
+
+
+def changed_objects(build_dir, changed_files, src=None, limit=1000):
+    """Return a list of up to limit object goals that can be built first to
+    quickly check changed_files. Objects known to depend on the most changed
+    files come first, followed by any new .c files that have not been built
+    yet."""
+    index = DepIndex(build_dir, src).update()
+    res = [I for I in index.affected(changed_files) if single_target_ok(I)]
+    known = set(res)
+    for I in changed_files:
+        I = os.path.normpath(os.fsdecode(I))
+        if not I.endswith(".c") or not single_target_ok(I):
+            continue
+        obj = I[:-2] + ".o"
+        if obj not in known and os.path.exists(
+                os.path.join(src or os.getcwd(), I)):
+            known.add(obj)
+            res.append(obj)
+    return res[:limit]
+
+
+# The compiler part of the command line saved in a .o.cmd file, matches what
+# scripts/clang-tools/gen_compile_commands.py does
+CMD_LINE_RE = re.compile(r"^(?:saved)?cmd_[^ ]*\.o := (.* )([^ ]*\.[cS]) *(;|$)")
+
+
+def load_compile_commands(build_dir):
+    """Return a dict mapping the absolute path of each source file to its
+    compile_commands.json entry"""
+    try:
+        with open(os.path.join(build_dir, "compile_commands.json")) as F:
+            entries = json.load(F)
+    except (OSError, ValueError):
+        return {}
+    return {
+        os.path.normpath(os.path.join(I["directory"], I["file"])): I
+        for I in entries
+    }
+
+
+def cmd_file_command(build_dir, src, fn):
+    """Return (directory, argv) to compile fn using the command kbuild saved in
+    its .o.cmd file, or None"""
+    rel = os.path.relpath(fn, src)
+    base, ext = os.path.splitext(rel)
+    if ext not in (".c", ".S"):
+        return None
+    cmd_fn = os.path.join(build_dir, os.path.dirname(rel),
+                          "." + os.path.basename(base) + ".o.cmd")
+    try:
+        with open(cmd_fn, "rt", errors="replace") as F:
+            for ln in F:
+                g = CMD_LINE_RE.match(ln)
+                if g is not None:
+                    return (os.path.abspath(build_dir),
+                            shlex.split(g.group(1) + g.group(2)))
+    except OSError:
+        pass
+    return None
+
+
+def compile_command(build_dir, src, fn, compdb):
+    """Return (directory, argv) to compile the absolute path fn, or None.
+    compdb is the result of load_compile_commands()"""
+    entry = compdb.get(fn)
+    if entry is not None:
+        if "arguments" in entry:
+            return entry["directory"], list(entry["arguments"])
+        return entry["directory"], shlex.split(entry["command"])
+    return cmd_file_command(build_dir, src, fn)
+
+
+def scratch_command(argv, out):
+    """Change a compile command to write its object to out, and any dependency
+    file next to it, so running it does not disturb the build directory"""
+    dep_fn = os.path.splitext(out)[0] + ".d"
+    res = []
+    itr = iter(argv)
+    for I in itr:
+        if I in ("-o", "-MF"):
+            next(itr, None)
+            res.extend([I, out if I == "-o" else dep_fn])
+        elif I.startswith(("-Wp,-MMD,", "-Wp,-MD,")):
+            res.append(I.rpartition(",")[0] + "," + dep_fn)
+        else:
+            res.append(I)
+    return res
+
+
+def write_compile_commands(path, entries):
+    """Write a compile_commands.json one entry at a time to a temporary file
+    and rename it into place, readers never see a partial file"""
+    with tempfile.NamedTemporaryFile("wt",
+                                     dir=os.path.dirname(path),
+                                     prefix=".compile_commands.",
+                                     delete=False) as F:
+        try:
+            F.write("[")
+            for idx, I in enumerate(entries):
+                F.write(",\n" if idx else "\n")
+                json.dump(I, F)
+            F.write("\n]\n")
+        except BaseException:
+            os.unlink(F.name)
+            raise
+    os.replace(F.name, path)
+
+
+def update_compile_commands(build_dir):
+    """Merge the commands from every .o.cmd file written since the last update
+    into the kernel compile_commands.json in build_dir. Nothing is done if
+    there is no compile_commands.json yet, kbuild makes the first one."""
+    build_dir = os.path.abspath(build_dir)
+    path = os.path.join(build_dir, "compile_commands.json")
+    stamp_fn = os.path.join(build_dir, ".gj-compdb-stamp")
+    try:
+        stamp = os.stat(stamp_fn).st_mtime_ns
+    except FileNotFoundError:
+        try:
+            # kbuild wrote it from every .cmd file
+            stamp = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    with open(stamp_fn, "w"):
+        pass
+    os.utime(stamp_fn)
+    new = {}
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        for fn in filenames:
+            obj = cmd_file_object(dirpath, fn, build_dir)
+            if obj is None:
+                continue
+            cmd_fn = os.path.join(dirpath, fn)
+            try:
+                if os.stat(cmd_fn).st_mtime_ns < stamp:
+                    continue
+                with open(cmd_fn, "rt", errors="replace") as F:
+                    for ln in F:
+                        g = CMD_LINE_RE.match(ln)
+                        if g is not None:
+                            break
+                    else:
+                        continue
+            except OSError:
+                continue
+            fn = os.path.normpath(os.path.join(build_dir, g.group(2)))
+            new[fn] = dict(command=g.group(1) + g.group(2),
+                           directory=build_dir,
+                           file=fn,
+                           output=obj)
+    if not new:
+        return False
+
+    compdb = load_compile_commands(build_dir)
+    compdb.update(new)
+    write_compile_commands(
+        path, (compdb[I] for I in sorted(compdb) if os.path.exists(I)))
+    return True
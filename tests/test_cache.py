@@ -0,0 +1,57 @@
+"""Check the size accounting of the ObjectCache and that a broken cache only
+costs the optimization"""
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gj_tools.cache import Namespace, ObjectCache  # noqa: E402
+
+
+def test_replace_keeps_size(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_size=1024 * 1024)
+    ns = cache.namespace("t", 1)
+    for I in range(10):
+        ns.put("k", b"x" * 1000)
+    assert cache.size == cache._total_size()
+    ns.put("k", b"x" * 10)
+    assert cache.size == cache._total_size()
+
+    # Replacing one key over and over must not push out the others
+    cache = ObjectCache(str(tmp_path / "small"), max_size=4000)
+    ns = cache.namespace("t", 1)
+    ns.put("other", b"y" * 1000)
+    for I in range(20):
+        ns.put("k", b"x" * 1000)
+    assert ns.get("other") == b"y" * 1000
+
+
+def test_broken_cache(tmp_path):
+    cache = ObjectCache(str(tmp_path))
+    ns = cache.namespace("t", 1)
+    ns.put("k", 1)
+    cache.close()
+    # Every operation on a closed database fails with sqlite3.Error
+    assert ns.get("k", "miss") == "miss"
+    ns.put("k", 2)
+    assert ns.memoize("k", lambda: 3) == 3
+
+    ns = Namespace(None, "t", 1)
+    assert ns.memoize("k", lambda: 4) == 4
+
+
+def test_read_only_cache(tmp_path):
+    cache = ObjectCache(str(tmp_path))
+    cache.namespace("t", 1).put("k", 1)
+    cache.close()
+
+    cache = ObjectCache(str(tmp_path))
+    cache.db.close()
+    cache.db = sqlite3.connect("file:%s?mode=ro" % (cache.path),
+                               uri=True,
+                               isolation_level=None,
+                               check_same_thread=False)
+    ns = cache.namespace("t", 1)
+    assert ns.get("k") == 1
+    ns.put("j", 2)
+    assert ns.memoize("j", lambda: 3) == 3
@@ -0,0 +1,166 @@
+"""Check that the read only git primitives give the same answers as the git CLI
+with every GitBackend, using small synthetic repositories."""
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gj_tools import git  # noqa: E402
+
+BACKENDS = ["cli", "pygit2"]
+
+
+def sh(*args):
+    return subprocess.check_output(args).decode().strip()
+
+
+def try_sh(*args):
+    try:
+        return subprocess.check_output(args,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+@pytest.fixture(scope="module", params=[1, 2])
+def repo(request, tmp_path_factory):
+    """A repository with branches, merges, annotated tags and remote refs
+    made from a seeded random walk. Returns (path, commits, refs)"""
+    rnd = random.Random(request.param)
+    path = str(tmp_path_factory.mktemp("repo"))
+    old = os.getcwd()
+    os.chdir(path)
+    try:
+        sh("git", "init", "-q")
+        sh("git", "config", "user.email", "a@example.com")
+        sh("git", "config", "user.name", "A")
+        commits = []
+        for i in range(40):
+            if commits and rnd.random() < 0.3:
+                sh("git", "checkout", "-q", "--detach", rnd.choice(commits))
+            if len(commits) > 3 and rnd.random() < 0.2:
+                try:
+                    sh("git", "merge", "-q", "--no-edit", "-m", "m%d" % (i),
+                       rnd.choice(commits))
+                except subprocess.CalledProcessError:
+                    sh("git", "merge", "--abort")
+            with open("f%d" % (i % 5), "a") as F:
+                F.write("%d\n" % (i))
+            sh("git", "add", "-A")
+            sh("git", "commit", "-qm", "c%d" % (i))
+            commits.append(sh("git", "rev-parse", "HEAD"))
+            if rnd.random() < 0.2:
+                sh("git", "branch", "-f", "b%d" % (i))
+            if rnd.random() < 0.15:
+                sh("git", "tag", "-a", "-m", "t", "t%d" % (i))
+            if rnd.random() < 0.1:
+                sh("git", "update-ref", "refs/remotes/r/x%d" % (i), "HEAD")
+        refs = sh("git", "for-each-ref", "--format=%(refname:short)").split()
+    finally:
+        os.chdir(old)
+    return path, commits, refs
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, repo, monkeypatch):
+    """Run in the repository with the caches of the git module cleared and
+    the given backend selected"""
+    if request.param == "pygit2":
+        pytest.importorskip("pygit2")
+    monkeypatch.setenv("GJ_GIT_BACKEND", request.param)
+    monkeypatch.chdir(repo[0])
+    git._backends.clear()
+    git._common_dirs.clear()
+    git.invalidate_ref_snapshots()
+    git.close_cat_file()
+    yield request.param
+    git._backends.clear()
+    git.close_cat_file()
+    assert git.git_backend().name == request.param
+
+
+def names(repo):
+    """Names that git can resolve, in several forms"""
+    path, commits, refs = repo
+    res = refs + ["HEAD", "HEAD~2", "HEAD^", commits[3][:10], commits[-1]]
+    res.extend(I + "^2" for I in commits if try_sh("git", "rev-parse", I +
+                                                     "^2") is not None)
+    return res
+
+
+def test_ref_id(repo, backend):
+    for name in names(repo) + ["HEAD^2"]:
+        assert git.git_ref_id(name, fail_is_none=True) == try_sh(
+            "git", "rev-parse", name), name
+    assert git.git_ref_id("does-not-exist", fail_is_none=True) is None
+
+
+def test_commit_id(repo, backend):
+    things = names(repo)
+    expected = [sh("git", "rev-parse", I + "^{commit}") for I in things]
+    for name, cid in zip(things, expected):
+        assert git.git_commit_id(name) == cid, name
+    assert git.git_commit_ids(things) == expected
+
+
+def test_read_objects(repo, backend):
+    things = names(repo)
+    for name, obj in zip(things, git.git_read_objects("commit", things)):
+        raw = subprocess.check_output(["git", "cat-file", "commit", name])
+        expected = git.parse_object(raw.splitlines())
+        assert obj.raw_keys == expected.raw_keys, name
+        assert obj.desc == expected.desc, name
+
+    # Trees are binary so compare what the backend returns directly, the CLI
+    # backend always answers None
+    trees = [I + "^{tree}" for I in things]
+    for name, raw in zip(trees, git.git_backend().read_objects("tree", trees)):
+        if raw is not None:
+            assert raw == ("tree",
+                           subprocess.check_output(
+                               ["git", "cat-file", "tree", name])), name
+
+
+def test_merge_base_and_ancestry(repo, backend):
+    path, commits, refs = repo
+    rnd = random.Random(0)
+    for _ in range(50):
+        cs = rnd.sample(commits, rnd.randint(2, 4))
+        expected = try_sh("git", "merge-base", *cs)
+        if expected is not None:
+            assert git.git_merge_base(cs) == expected, cs
+
+        a, b = rnd.sample(commits, 2)
+        expected = subprocess.call(
+            ["git", "merge-base", "--is-ancestor", a, b]) == 0
+        assert git.git_is_ancestor(a, b) == expected, (a, b)
+
+
+def test_auto_falls_back(tmp_path, monkeypatch):
+    """A repository libgit2 cannot open is answered by git in auto mode"""
+    pytest.importorskip("pygit2")
+    monkeypatch.chdir(tmp_path)
+    sh("git", "init", "-q")
+    sh("git", "-c", "user.email=a@example.com", "-c", "user.name=A", "commit",
+       "-q", "--allow-empty", "-m", "c")
+    sh("git", "config", "core.repositoryformatversion", "1")
+    sh("git", "config", "extensions.partialclone", "origin")
+    git._backends.clear()
+    git.invalidate_ref_snapshots()
+    git.close_cat_file()
+    try:
+        monkeypatch.setenv("GJ_GIT_BACKEND", "auto")
+        assert git.git_backend().name == "cli"
+        assert git.git_commit_id("HEAD") == sh("git", "rev-parse", "HEAD")
+
+        import pygit2
+        git._backends.clear()
+        monkeypatch.setenv("GJ_GIT_BACKEND", "pygit2")
+        with pytest.raises(pygit2.GitError):
+            git.git_backend()
+    finally:
+        git._backends.clear()
+        git.close_cat_file()